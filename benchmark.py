@@ -0,0 +1,398 @@
+#
+# Benchmarks of the APOD Viewer, run against a local stand-in of the APOD API
+# so that no request reaches api.nasa.gov. Each scenario is run at every
+# requested scale and the results are written as JSON, to be compared with
+# the results of an earlier run.
+#
+# Usage: python benchmark.py [--scales 1000,10000,100000] [--image-size 1024x768]
+#                            [--latency 20] [--ingest-limit 200] [--output results.json]
+#                            [--compare earlier.json] [--threshold 0.2]
+#
+#
+# Imports
+import argparse
+import asyncio
+import contextlib
+import datetime
+import hashlib
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from urllib.parse import parse_qs, urlparse
+
+import numpy
+from PIL import Image
+
+import main
+
+#
+# Settings
+#
+# The scales the scenarios are run at, in entries
+BENCHMARK_SCALES = (1000, 10000, 100000)
+# The size of the synthetic images, in pixels
+BENCHMARK_IMAGE_SIZE = (1024, 768)
+# How many milliseconds the stand-in server waits before each answer
+BENCHMARK_LATENCY = 20
+# Up to how many entries are fetched, ingested and backfilled at each scale
+BENCHMARK_INGEST_LIMIT = 200
+# How many searches are run at each scale
+BENCHMARK_SEARCHES = 200
+# How many images are decoded by the view scenarios
+BENCHMARK_VIEWS = 100
+# How many times the catalog is loaded
+BENCHMARK_CATALOG_LOADS = 5
+# How many times the program is started by the startup scenarios
+BENCHMARK_STARTUPS = 10
+# How many clients are connected to the HTTP server at once, and how many requests they send in all
+BENCHMARK_SERVE_CLIENTS = 200
+BENCHMARK_SERVE_REQUESTS = 2000
+# How many entries are seeded into the database at a time
+BENCHMARK_SEED_BATCH = 10000
+# By how much a scenario may get slower before the comparison fails
+BENCHMARK_THRESHOLD = 0.2
+# The words the synthetic titles and explanations are made of
+BENCHMARK_WORDS = ("nebula", "galaxy", "comet", "aurora", "eclipse", "cluster", "supernova", "moon", "mars",
+                   "jupiter", "saturn", "orion", "andromeda", "milky", "way", "star", "dust", "gas", "cloud",
+                   "spiral", "planet", "solar", "flare", "meteor", "shower", "horizon", "telescope", "hubble",
+                   "webb", "infrared", "light", "dark", "pillar", "creation", "crab", "ring", "sombrero", "pulsar")
+# The first date of the seeded entries, of the ingested entries and of the backfilled entries
+SEED_START = datetime.date(1700, 1, 1)
+INGEST_START = datetime.date(1600, 1, 1)
+BACKFILL_START = datetime.date(1500, 1, 1)
+# The stand-in server's settings (set by main)
+server_settings = {'image_size': BENCHMARK_IMAGE_SIZE, 'latency': BENCHMARK_LATENCY / 1000}
+
+
+#
+# Make the synthetic image of a date, different for every date
+#
+def synthetic_image(date):
+      width, height = server_settings['image_size']
+      generator = numpy.random.default_rng(int(hashlib.sha256(date.encode()).hexdigest()[:16], 16))
+      # A coarse random pattern stretched over the image gives every date its own look
+      pattern = Image.fromarray(generator.integers(0, 256, (6, 8, 3), dtype=numpy.uint8)).resize((width, height), Image.BILINEAR)
+      # Fine noise keeps the file about as large as a real photograph
+      pixels = numpy.asarray(pattern, dtype=numpy.int16) + generator.integers(-24, 24, (height, width, 3), dtype=numpy.int16)
+      image_buffer = BytesIO()
+      Image.fromarray(numpy.clip(pixels, 0, 255).astype(numpy.uint8)).save(image_buffer, 'JPEG', quality=90)
+      return image_buffer.getvalue()
+#
+# Make the synthetic APOD data of a date
+#
+def synthetic_apod(date, base_url):
+      words = random.Random(date)
+      return {'date': date, 'media_type': 'image', 'url': f"{base_url}/image/{date}.jpg",
+              'title': " ".join(words.choices(BENCHMARK_WORDS, k=3)).title(),
+              'explanation': " ".join(words.choices(BENCHMARK_WORDS, k=60)).capitalize() + "."}
+#
+# The stand-in of the APOD API
+#
+class APODHandler(BaseHTTPRequestHandler):
+      # Keep the connections of the shared session alive, and send small answers right away
+      protocol_version = "HTTP/1.1"
+      disable_nagle_algorithm = True
+      #
+      # Answer a request
+      #
+      def do_GET(self):
+            request = urlparse(self.path)
+            parameters = {key: values[0] for key, values in parse_qs(request.query).items()}
+            base_url = f"http://{self.server.server_address[0]}:{self.server.server_address[1]}"
+            # Every answer takes as long as a trip to the real servers
+            time.sleep(server_settings['latency'])
+            if (request.path == '/planetary/apod'):
+                  # A window of dates, or a single one
+                  if ('start_date' in parameters):
+                        date = datetime.date.fromisoformat(parameters['start_date'])
+                        end_date = datetime.date.fromisoformat(parameters.get('end_date', parameters['start_date']))
+                        apod_data = []
+                        while (date <= end_date):
+                              apod_data.append(synthetic_apod(date.isoformat(), base_url))
+                              date += datetime.timedelta(days=1)
+                  else:
+                        apod_data = synthetic_apod(parameters.get('date', SEED_START.isoformat()), base_url)
+                  self.answer(json.dumps(apod_data).encode(), 'application/json')
+            elif (request.path.startswith('/image/')):
+                  self.answer(synthetic_image(request.path[len('/image/'):-len('.jpg')]), 'image/jpeg')
+            else:
+                  self.send_error(404)
+      #
+      # Send a body
+      #
+      def answer(self, body, content_type):
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+      #
+      # Keep the output of the benchmark clean
+      #
+      def log_message(self, format, *arguments):
+            pass
+#
+# Start the stand-in server on a free port
+#
+def start_server():
+      server = ThreadingHTTPServer(('127.0.0.1', 0), APODHandler)
+      server.daemon_threads = True
+      threading.Thread(target=server.serve_forever, name="benchmark-server", daemon=True).start()
+      return server
+#
+# Start the application's HTTP server on a free port, in its own thread
+#
+def start_archive_server():
+      loop = asyncio.new_event_loop()
+      started = threading.Event()
+      address = []
+      serving = loop.create_task(main.run_server('127.0.0.1', 0, lambda server_address: (address.append(server_address), started.set())))
+      def run():
+            with contextlib.suppress(asyncio.CancelledError):
+                  loop.run_until_complete(serving)
+            loop.run_until_complete(loop.shutdown_default_executor())
+            loop.close()
+      thread = threading.Thread(target=run, name="benchmark-archive-server", daemon=True)
+      with contextlib.redirect_stdout(sys.stderr):
+            thread.start()
+            started.wait()
+      # Stop the server and wait for its thread
+      def stop():
+            loop.call_soon_threadsafe(serving.cancel)
+            thread.join()
+      return address[0][1], stop
+#
+# Send requests to the HTTP server from many keep-alive connections at once, timing every answer
+#
+async def serve_clients(port, paths, clients, latencies):
+      async def client(paths):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            for path in paths:
+                  request_started = time.perf_counter()
+                  writer.write(f"GET {path} HTTP/1.1\r\nHost: benchmark\r\n\r\n".encode())
+                  head = await reader.readuntil(b"\r\n\r\n")
+                  length = next(int(line.split(b":")[1]) for line in head.split(b"\r\n") if line.lower().startswith(b"content-length:"))
+                  await reader.readexactly(length)
+                  latencies.append(time.perf_counter() - request_started)
+            writer.close()
+            await writer.wait_closed()
+      await asyncio.gather(*(client(paths[first::clients]) for first in range(clients)))
+#
+# Find the percentile of sorted latencies
+#
+def percentile(latencies, fraction):
+      return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+#
+# Run a scenario, timing every operation (unless the operations time their own steps) and tracing the peak memory
+#
+def run_scenario(name, scale, operations, latencies=None):
+      timings = []
+      tracemalloc.start()
+      started = time.perf_counter()
+      # Hide the output of the application while it runs
+      with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            for operation in operations:
+                  operation_started = time.perf_counter()
+                  operation()
+                  timings.append(time.perf_counter() - operation_started)
+      elapsed = time.perf_counter() - started
+      peak_memory = tracemalloc.get_traced_memory()[1]
+      tracemalloc.stop()
+      latencies = sorted(timings if latencies is None else latencies)
+      result = {'scenario': name, 'scale': scale, 'operations': len(latencies), 'seconds': round(elapsed, 4),
+                'throughput': round(len(latencies) / elapsed, 2) if elapsed else None,
+                'p50_ms': round(percentile(latencies, 0.50) * 1000, 3) if latencies else None,
+                'p99_ms': round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+                'peak_memory_bytes': peak_memory}
+      print(f"[INFO] {name} at {scale}: {result['throughput']} ops/s, p50 {result['p50_ms']} ms, p99 {result['p99_ms']} ms.", file=sys.stderr)
+      return result
+#
+# Point the application at an empty working directory
+#
+def reset_application(directory):
+      main.close_database()
+      with main.http_cache_lock:
+            if (main.http_cache is not None):
+                  main.http_cache.close()
+            main.http_cache = None
+      main.APOD_DIRECTORY = os.path.join(directory, 'APOD')
+      main.STORE_DIRECTORY = os.path.join(main.APOD_DIRECTORY, 'store')
+      main.THUMBNAIL_DIRECTORY = os.path.join(main.APOD_DIRECTORY, 'thumbnails')
+      main.HTTP_CACHE_FILE = os.path.join(main.APOD_DIRECTORY, 'http_cache.db')
+      main.similarity_index.update(tree=None, signature=None)
+      os.chdir(directory)
+      with open("NASA_API_KEY.txt", "wt") as api_key_file:
+            api_key_file.write("BENCHMARK")
+      with contextlib.redirect_stdout(sys.stderr):
+            main.connect(os.path.join(directory, 'database'))
+#
+# Fill the database with synthetic entries
+#
+def seed_entries(scale, base_url):
+      hashes = random.Random(scale)
+      for first in range(0, scale, BENCHMARK_SEED_BATCH):
+            rows = []
+            for day in range(first, min(scale, first + BENCHMARK_SEED_BATCH)):
+                  apod_data = synthetic_apod((SEED_START + datetime.timedelta(days=day)).isoformat(), base_url)
+                  rows.append(main.entry_row(apod_data, "", hashes.getrandbits(64) - (1 << 63)))
+            with main.transaction() as connection:
+                  main.create_entries(connection, rows)
+#
+# Fetch, store and save one entry the way an update does
+#
+def ingest(api_key, date):
+      main.ingest(main.get_apod(api_key, date, date))
+#
+# Load the catalog again, from the database or from the file it was saved to
+#
+def load_catalog(build):
+      main.catalog['version'] = None
+      if (build and os.path.exists(main.catalog_path())):
+            os.remove(main.catalog_path())
+      main.entries_catalog()
+#
+# Run every scenario at a scale
+#
+def benchmark_scale(scale, base_url, ingest_limit):
+      results = []
+      dates = lambda start, count: [(start + datetime.timedelta(days=day)).isoformat() for day in range(count)]
+      ingest_count = min(scale, ingest_limit)
+      started = time.perf_counter()
+      seed_entries(scale, base_url)
+      print(f"[INFO] Seeded {scale} entries in {time.perf_counter() - started:.1f} seconds.", file=sys.stderr)
+      # Fetching the metadata of single dates, all missing from the cache
+      results.append(run_scenario('fetch', scale, [lambda date=date: main.get_apod("BENCHMARK", date, date)
+                                                   for date in dates(INGEST_START - datetime.timedelta(days=ingest_count), ingest_count)]))
+      # Ingesting new entries one at a time
+      results.append(run_scenario('ingest', scale, [lambda date=date: ingest("BENCHMARK", date)
+                                                    for date in dates(INGEST_START, ingest_count)]))
+      # Backfilling a window of dates, timed per download
+      download = main.ingest_download
+      download_latencies = []
+      def timed_download(apod_data):
+            download_started = time.perf_counter()
+            try:
+                  return download(apod_data)
+            finally:
+                  download_latencies.append(time.perf_counter() - download_started)
+      main.ingest_download = timed_download
+      try:
+            window = dates(BACKFILL_START, ingest_count)
+            results.append(run_scenario('backfill', scale, [lambda: main.backfill(window[0], window[-1])], download_latencies))
+      finally:
+            main.ingest_download = download
+      # Searching, one page of results per query
+      queries = random.Random(scale)
+      results.append(run_scenario('search', scale, [lambda words=" ".join(queries.choices(BENCHMARK_WORDS, k=queries.randint(1, 2))): main.search(words)
+                                                    for _ in range(BENCHMARK_SEARCHES)]))
+      # Loading the catalog of the entries, from the database and from its file
+      for name in ('catalog_build', 'catalog_load'):
+            results.append(run_scenario(name, scale, [lambda build=name == 'catalog_build': load_catalog(build)
+                                                      for _ in range(BENCHMARK_CATALOG_LOADS)]))
+      # Listing every entry a page at a time, by date and by title
+      for sort_key, descending in (('date', False), ('title', True)):
+            pages = main.list_pages(sort_key, descending)
+            results.append(run_scenario(f'list_{sort_key}', scale, [lambda: next(pages, None)
+                                                                    for _ in range(scale // main.LIST_PAGE_SIZE + 1)]))
+      # Decoding previews for the viewer, before and after they are cached
+      locations = [row[0] for row in main.fetch_all("SELECT image_location FROM entries WHERE image_location != '' LIMIT ?", (BENCHMARK_VIEWS,))]
+      shutil.rmtree(main.THUMBNAIL_DIRECTORY, ignore_errors=True)
+      for name in ('view_cold', 'view_warm'):
+            results.append(run_scenario(name, scale, [lambda location=location: main.decode_preview(location) for location in locations]))
+      # Serving pages of the catalog and stored images to many clients at once
+      port, stop_archive_server = start_archive_server()
+      try:
+            requests = random.Random(scale)
+            ids = [row[0] for row in main.fetch_all("SELECT id FROM entries WHERE image_location != '' LIMIT ?", (BENCHMARK_VIEWS,))]
+            for name, path in (('serve_list', lambda: f"/entries?page={requests.randint(1, scale // main.LIST_PAGE_SIZE)}"),
+                               ('serve_image', lambda: f"/entries/{requests.choice(ids)}/image")):
+                  paths = [path() for _ in range(BENCHMARK_SERVE_REQUESTS)]
+                  serve_latencies = []
+                  results.append(run_scenario(name, scale, [lambda: asyncio.run(serve_clients(port, paths, BENCHMARK_SERVE_CLIENTS, serve_latencies))],
+                                              serve_latencies))
+      finally:
+            stop_archive_server()
+      # Starting the program, alone and to run a search from the command line
+      environment = dict(os.environ, HOME=os.getcwd(), PYTHONPATH=os.path.dirname(os.path.abspath(main.__file__)))
+      for name, arguments in (('startup_import', ['-c', 'import main']), ('startup_search', [main.__file__, 'search', 'nebula'])):
+            results.append(run_scenario(name, scale, [lambda arguments=arguments: subprocess.run([sys.executable] + arguments, check=True, env=environment,
+                                                                                                   cwd=os.getcwd(), stdout=subprocess.DEVNULL)
+                                                      for _ in range(BENCHMARK_STARTUPS)]))
+      return results
+#
+# Compare the results with those of an earlier run
+#
+def compare(results, earlier_results, threshold):
+      # Results are only comparable under the same settings
+      if (earlier_results.get('settings') != results['settings']):
+            print(f"[WARNING] The earlier run used other settings: {earlier_results.get('settings')}", file=sys.stderr)
+      earlier = {(result['scenario'], result['scale']): result for result in earlier_results['results']}
+      regressions = 0
+      for result in results['results']:
+            before = earlier.get((result['scenario'], result['scale']))
+            if (before is None or not before['throughput'] or not result['throughput']):
+                  continue
+            # Compare the throughput and the tail latency
+            change = before['throughput'] / result['throughput'] - 1
+            tail_change = result['p99_ms'] / before['p99_ms'] - 1 if before['p99_ms'] else 0
+            regressed = change > threshold or tail_change > threshold
+            regressions += regressed
+            print(f"[{'WARNING' if regressed else 'INFO'}] {result['scenario']} at {result['scale']}: "
+                  f"throughput {before['throughput']} -> {result['throughput']} ops/s, "
+                  f"p99 {before['p99_ms']} -> {result['p99_ms']} ms.", file=sys.stderr)
+      return regressions
+#
+# Main
+#
+if __name__ == "__main__":
+      parser = argparse.ArgumentParser(description="Benchmark the APOD Viewer against a local stand-in of the APOD API.")
+      parser.add_argument('--scales', default=",".join(map(str, BENCHMARK_SCALES)), help="comma separated numbers of entries")
+      parser.add_argument('--image-size', default="x".join(map(str, BENCHMARK_IMAGE_SIZE)), help="size of the synthetic images, e.g. 1024x768")
+      parser.add_argument('--latency', type=float, default=BENCHMARK_LATENCY, help="milliseconds the server waits before each answer")
+      parser.add_argument('--ingest-limit', type=int, default=BENCHMARK_INGEST_LIMIT, help="most entries fetched, ingested and backfilled per scale")
+      parser.add_argument('--output', help="file to write the results to, instead of the standard output")
+      parser.add_argument('--compare', help="results of an earlier run to compare with")
+      parser.add_argument('--threshold', type=float, default=BENCHMARK_THRESHOLD, help="slowdown that counts as a regression")
+      options = parser.parse_args()
+      server_settings['image_size'] = tuple(int(size) for size in options.image_size.lower().split('x'))
+      server_settings['latency'] = options.latency / 1000
+      # Start the stand-in server and send the application there
+      server = start_server()
+      base_url = f"http://127.0.0.1:{server.server_address[1]}"
+      main.APOD_API_URL = f"{base_url}/planetary/apod"
+      # The stand-in server has no rate limit
+      main.RATE_LIMIT_PER_HOUR = float('inf')
+      main.RATE_LIMIT_BURST = float('inf')
+      # The viewer is measured on its own, without a display
+      main.image_viewer = lambda image_location: None
+      results = {'created': datetime.datetime.now().isoformat(timespec='seconds'), 'python': sys.version.split()[0],
+                 'settings': {'image_size': list(server_settings['image_size']), 'latency_ms': options.latency,
+                              'ingest_limit': options.ingest_limit}, 'results': []}
+      working_directory = os.getcwd()
+      for scale in (int(scale) for scale in options.scales.split(',')):
+            with tempfile.TemporaryDirectory(prefix="apod-benchmark-") as directory:
+                  reset_application(directory)
+                  results['results'].extend(benchmark_scale(scale, base_url, options.ingest_limit))
+                  main.close_database()
+                  os.chdir(working_directory)
+      server.shutdown()
+      # Write the results
+      if (options.output):
+            with open(options.output, "wt") as output_file:
+                  json.dump(results, output_file, indent=2)
+      else:
+            print(json.dumps(results, indent=2))
+      # Fail when a scenario got slower than the earlier run
+      if (options.compare):
+            with open(options.compare, "rt") as earlier_file:
+                  regressions = compare(results, json.load(earlier_file), options.threshold)
+            sys.exit(1 if regressions else 0)
@@ -12,86 +12,893 @@
 #
 #
 # FUTURE FIXES
-# TODO: verify if database exists or not
-# TODO: if not manage to take actions
 # TODO: dynamic time greeting
 # TODO: first time launch api key request from user
-# TODO: Search for something like the requested search.
 # TODO: General code/interface polishing
-# TODO: Don't update the database if the entry already exists
 # TODO: Ask user for API Key and then store it in a seperate file
 #
 #
-# Imports
+# Imports (the heavy ones are imported by the functions that need them, to start fast)
+import argparse
+import contextlib
 import datetime
-import multiprocessing
+import hashlib
+import json
+import mimetypes
 import os
+import queue
 import random
+import re
 import sqlite3
+import sys
+import tempfile
 import threading
 import time
+from array import array
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from pathlib import Path
-from tkinter import Label, Tk, filedialog
 
-import requests
-from PIL import Image, ImageTk
-from sqlalchemy import null
+#
+# Settings
+#
+# The database file, without its extension
+DATABASE_FILE = "database"
+# How many connections the database pool may open
+DATABASE_POOL_SIZE = 4
+# How many seconds a connection waits for a lock held by another one
+DATABASE_TIMEOUT = 30
+# How many kilobytes of pages each connection caches
+DATABASE_CACHE_KB = 16 * 1024
+# How many prepared statements each connection keeps
+DATABASE_CACHED_STATEMENTS = 256
+# How many backfilled entries are written to the database at a time
+BACKFILL_BATCH = 50
+# NASA's APOD API endpoint
+APOD_API_URL = 'https://api.nasa.gov/planetary/apod'
+# The folder of the APOD collection
+APOD_DIRECTORY = os.path.join(os.path.expanduser("~"), 'Pictures', 'Space', 'APOD')
+# The content-addressed image store inside the collection
+STORE_DIRECTORY = os.path.join(APOD_DIRECTORY, 'store')
+# The cache of pre-rendered previews inside the collection
+THUMBNAIL_DIRECTORY = os.path.join(APOD_DIRECTORY, 'thumbnails')
+# The variants kept in the thumbnail cache, largest first
+THUMBNAIL_SIZES = {'preview': (800, 600), 'list': (160, 120)}
+# How many bytes the thumbnail cache may use before the least recently used are evicted
+THUMBNAIL_CACHE_LIMIT = 256 * 1024 * 1024
+# How full the thumbnail cache is left after an eviction, so the next ones are far apart
+THUMBNAIL_CACHE_TARGET = 0.8
+# Guard the eviction of the thumbnail cache across threads
+thumbnail_lock = threading.Lock()
+# The running size of the thumbnail cache, counted once per folder and then kept up to date
+thumbnail_cache = {'directory': None, 'size': None}
+# How many search results are shown per page
+SEARCH_PAGE_SIZE = 10
+# The format and quality the optimize command re-encodes images to by default
+OPTIMIZE_FORMAT = 'jpeg'
+OPTIMIZE_QUALITY = 85
+# The formats images can be re-encoded to, with their extensions
+OPTIMIZE_FORMATS = {'jpeg': '.jpg', 'webp': '.webp', 'png': '.png'}
+# How many optimized images are committed to the database at a time
+OPTIMIZE_BATCH = 50
+# Up to how many bits the hashes of two images may differ for them to count as near-duplicates
+NEAR_DUPLICATE_DISTANCE = 4
+# How many similar images are listed
+SIMILAR_RESULTS = 10
+# The first bytes of a saved catalog file
+CATALOG_MAGIC = b"APODCAT2"
+# How many entries are listed per page
+LIST_PAGE_SIZE = 20
+# The columns the entries can be sorted by
+SORT_COLUMNS = ('date', 'title', 'id')
+# How many bytes are read from a response at a time
+CHUNK_SIZE = 64 * 1024
+# The local cache of HTTP responses
+HTTP_CACHE_FILE = os.path.join(APOD_DIRECTORY, 'http_cache.db')
+# How many seconds the metadata of past dates and the images stay fresh before they are revalidated
+ARCHIVE_CACHE_TTL = 30 * 24 * 3600
+# How many seconds a response without the APOD of the local today stays fresh, until NASA publishes it
+APOD_PENDING_TTL = 15 * 60
+# How many hours NASA's day is behind UTC, at most (the APOD changes day at midnight in US Eastern time)
+APOD_UTC_OFFSET = -5
+# How many seconds a request may take to connect, and to receive data
+REQUEST_TIMEOUT = (5, 30)
+# How many times a failed request is retried
+REQUEST_RETRIES = 4
+# The base and the cap of the exponential backoff between retries, in seconds
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+# How many API requests a key may make per hour, and how many may be sent in a burst
+RATE_LIMIT_PER_HOUR = 1000
+RATE_LIMIT_BURST = 10
+# Up to how many seconds a request waits for the rate limit, instead of failing
+RATE_LIMIT_MAX_WAIT = 10
+# After how many failures in a row the NASA servers are left alone, and for how many seconds
+CIRCUIT_THRESHOLD = 5
+CIRCUIT_COOLDOWN = 60
+# How many images are downloaded at the same time during a backfill
+BACKFILL_WORKERS = 8
+# How many images are validated, hashed and thumbnailed at the same time
+DECODE_WORKERS = 2
+# How many entries may wait between two stages of the ingestion
+INGEST_QUEUE_SIZE = 32
+# Store the high-resolution image of a day when there is one
+INGEST_HD = True
+# How many seconds the program waits for the background update to stop when exiting
+SHUTDOWN_TIMEOUT = 10
+# How many seconds the background update waits between polls
+AUTO_UPDATE_INTERVAL = 3600
+# Up to how many seconds are added to or removed from each wait
+AUTO_UPDATE_JITTER = 300
+# How many functions and allocation sites a profiled command reports
+PROFILE_LINES = 20
+# The file the statistics of a profiled command are saved to, for other profiling tools
+PROFILE_FILE = "apod.prof"
+# The address the HTTP server listens on by default
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 8000
+# How many connections may wait to be accepted by the HTTP server
+SERVER_BACKLOG = 512
+# How many bytes the request line and the headers of a request may take
+SERVER_HEADER_LIMIT = 16 * 1024
+# How many seconds an idle connection is kept open
+SERVER_IDLE_TIMEOUT = 15
+# How many threads run the database work and the NASA requests of the HTTP server
+SERVER_WORKERS = 8
+# Up to how many entries a page of the HTTP server may hold
+SERVER_PAGE_LIMIT = 1000
+# The name the HTTP server answers with
+SERVER_NAME = "APOD"
+# The HTTP session shared by every request (created on first use)
+http_session = None
+# Guard the creation of the shared session across threads
+http_session_lock = threading.Lock()
+# The path of the database (set by connect)
+database_path = None
+# The idle connections of the database pool
+database_pool = queue.LifoQueue()
+# How many connections the pool has opened
+database_pool_state = {'open': 0}
+# Guard the opening of pooled connections across threads
+database_pool_lock = threading.Lock()
+# The compact catalog of the entries (their IDs, days as ordinals and UTF-8 titles in columns ordered by date,
+# and the orders of the other sort keys), and the identity of the database and version of the entries it was loaded from
+catalog = {'entries': None, 'version': None}
+# Guard the catalog across threads
+catalog_lock = threading.Lock()
+# The BK-tree of the perceptual hashes, the same hashes as flat arrays, and the state of the entries they were built from
+similarity_index = {'tree': None, 'ids': array('q'), 'hashes': array('q'), 'signature': None}
+# Guard the similarity index across threads
+similarity_lock = threading.Lock()
+# The requests for the image viewer thread
+viewer_queue = queue.Queue()
+# The request that stops the image viewer thread
+VIEWER_STOP = object()
+# The image viewer thread (started on first use)
+viewer_thread = None
+# Set when the viewer window is closed
+viewer_closed = threading.Event()
+# The widgets and prefetch workers of the image viewer thread
+viewer = {}
+# The decoded previews of the image on screen and its neighbours, by image location
+viewer_prefetch = {}
+# The token buckets that space out the API requests, one per key
+rate_limits = {}
+# The circuit breaker that stops requests after repeated failures
+circuit = {'failures': 0, 'opened': 0.0}
+# Guard the token bucket and the circuit breaker across threads
+request_lock = threading.Lock()
+# Set when the program exits, so no request keeps waiting to be sent
+request_stop = threading.Event()
+# The connection to the HTTP cache (opened on first use)
+http_cache = None
+# Guard the HTTP cache and its counters across threads
+http_cache_lock = threading.Lock()
+# How the HTTP cache has been doing
+cache_stats = {'hits': 0, 'misses': 0, 'revalidated': 0}
+# The API keys already found valid, along with the day they were checked
+valid_api_keys = {}
+# The timings of the hot paths, by operation: how many, their total and their longest, in seconds
+metrics_timings = {}
+# The counters of the hot paths, by name
+metrics_counters = {}
+# Guard the metrics across threads
+metrics_lock = threading.Lock()
 
 
+#
+# Time an operation, as a block or as a decorator of a whole function
+#
+@contextlib.contextmanager
+def measure(operation):
+      started = time.perf_counter()
+      try:
+            yield
+      finally:
+            elapsed = time.perf_counter() - started
+            with metrics_lock:
+                  timing = metrics_timings.setdefault(operation, [0, 0.0, 0.0])
+                  timing[0] += 1
+                  timing[1] += elapsed
+                  timing[2] = max(timing[2], elapsed)
+#
+# Add to a counter
+#
+def count_metric(name, amount=1):
+      with metrics_lock:
+            metrics_counters[name] = metrics_counters.get(name, 0) + amount
+#
+# Take a consistent copy of the metrics
+#
+def metrics_snapshot():
+      with metrics_lock:
+            timings = {operation: tuple(timing) for operation, timing in metrics_timings.items()}
+            counters = dict(metrics_counters)
+      with http_cache_lock:
+            counters.update({f"http_cache_{stat}": value for stat, value in cache_stats.items()})
+      return timings, counters
+#
+# Write the metrics in the Prometheus text format
+#
+def prometheus_metrics():
+      timings, counters = metrics_snapshot()
+      lines = ["# HELP apod_operation_seconds Time spent in the hot paths.", "# TYPE apod_operation_seconds summary"]
+      for operation, (count, total, longest) in sorted(timings.items()):
+            lines.append(f'apod_operation_seconds_count{{operation="{operation}"}} {count}')
+            lines.append(f'apod_operation_seconds_sum{{operation="{operation}"}} {total:.6f}')
+      lines += ["# HELP apod_operation_max_seconds Longest run of each hot path.", "# TYPE apod_operation_max_seconds gauge"]
+      for operation, (count, total, longest) in sorted(timings.items()):
+            lines.append(f'apod_operation_max_seconds{{operation="{operation}"}} {longest:.6f}')
+      for name, value in sorted(counters.items()):
+            lines += [f"# TYPE apod_{name}_total counter", f"apod_{name}_total {value}"]
+      return "\n".join(lines) + "\n"
+#
+# Show or export the metrics
+#
+def stats(arguments=()):
+      try:
+            # Options are read in any case, file names as given
+            option = arguments[0].lower() if arguments else None
+            # Export to a file, replaced at once so a collector never reads half of it
+            if (option in ('export', 'prometheus')):
+                  if (len(arguments) < 2):
+                        raise ValueError("No file given")
+                  timings, counters = metrics_snapshot()
+                  if (option == 'export'):
+                        body = json.dumps({'timings': {operation: dict(zip(('count', 'seconds', 'max_seconds'), timing)) for operation, timing in timings.items()},
+                                           'counters': counters}, indent=2)
+                  else:
+                        body = prometheus_metrics()
+                  metrics_path = os.path.expanduser(arguments[1])
+                  with open(metrics_path + ".part", "wt") as metrics_file:
+                        metrics_file.write(body)
+                  os.replace(metrics_path + ".part", metrics_path)
+                  print(f"[INFO] Metrics written to {metrics_path}.")
+                  return
+            # Start counting from zero
+            if (option == 'reset'):
+                  with metrics_lock:
+                        metrics_timings.clear()
+                        metrics_counters.clear()
+                  print("[INFO] Metrics reset.")
+                  return
+            if (arguments):
+                  raise ValueError(f"Unknown option '{arguments[0]}'")
+            # Show every timing and counter
+            timings, counters = metrics_snapshot()
+            print("\nOperation            Count     Total (s)   Average (ms)   Max (ms)")
+            for operation, (count, total, longest) in sorted(timings.items()):
+                  print(f"{operation:<20} {count:>5} {total:>13.3f} {total / count * 1000:>14.2f} {longest * 1000:>10.2f}")
+            print("\nCounters: ")
+            for name, value in sorted(counters.items()):
+                  print(f"    {name}: {value}")
+      except Exception as e:
+            print(f"[ERROR] Unable to show metrics: {e}")
+#
+# Run a single command under the profiler and the memory tracer
+#
+def profile(arguments):
+      if (not arguments):
+            print("[ERROR] No command to profile.")
+            return
+      profile_call(' '.join(arguments), run_command, arguments[0].lower(), arguments[1:])
+#
+# Run a function under the profiler and the memory tracer
+#
+def profile_call(description, function, *arguments):
+      import cProfile
+      import pstats
+      import tracemalloc
+      profiler = cProfile.Profile()
+      tracemalloc.start()
+      try:
+            profiler.runcall(function, *arguments)
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+      finally:
+            tracemalloc.stop()
+      # Show where the time went
+      print(f"\n[INFO] Profile of '{description}':")
+      statistics = pstats.Stats(profiler)
+      statistics.sort_stats('cumulative').print_stats(PROFILE_LINES)
+      statistics.dump_stats(PROFILE_FILE)
+      print(f"[INFO] Profile saved to {PROFILE_FILE}.")
+      # Show where the memory went
+      print(f"[INFO] Memory: {current / 1024:.0f} KiB still allocated, {peak / 1024:.0f} KiB at the peak.")
+      for statistic in snapshot.statistics('lineno')[:PROFILE_LINES]:
+            print(f"    {statistic}")
 #
 # Server ping utility
 #
-def ping(api_key):
-      # Check API integrity
-      apod_url = f'https://api.nasa.gov/planetary/apod?api-key={api_key}'
-      # Request for a response
-      response = requests.get(apod_url)
-      # Check the status code of the response
-      if (response.status_code == 200):
-            print("[INFO] The provided API key is valid.")
-      elif (response.status_code == 403):
-            print("[ERROR] The provided API key is invalid. Access forbidden (403)")
-      else:
-            print(f"[ERROR] Unexpected response. Status code: {response.status_code}")
-      # Return the status code
-      return response.status_code
+def ping(api_key=None):
+      try:
+            # Check the key of the local txt file unless another one is given
+            api_key = api_key or read_api_key()
+            # A key found valid today does not need another round trip
+            if (valid_api_keys.get(api_key) == datetime.date.today()):
+                  count_cache('hits')
+                  status_code = 200
+            else:
+                  count_cache('misses')
+                  # Request for a response, without downloading its payload
+                  response = nasa_get(APOD_API_URL, params={'api_key': api_key}, stream=True)
+                  response.close()
+                  status_code = response.status_code
+                  # Remember the valid key for the rest of the day
+                  if (status_code == 200):
+                        valid_api_keys[api_key] = datetime.date.today()
+            # Check the status code of the response
+            if (status_code == 200):
+                  print("[INFO] The provided API key is valid.")
+            elif (status_code == 403):
+                  print("[ERROR] The provided API key is invalid. Access forbidden (403)")
+            else:
+                  print(f"[ERROR] Unexpected response. Status code: {status_code}")
+            # Return the status code
+            return status_code
+      except Exception as e:
+            print(f"[ERROR] Unable to ping the NASA servers: {e}")
 #
-# A custom image viewer
+# Name the thumbnails of an image after its path and version
 #
-def image_viewer(image_location):
+def thumbnail_key(image_location):
+      # A changed image gets a new size or modification time
+      image_stat = os.stat(image_location)
+      # Hash the path along with the version of the image
+      identity = f"{os.path.abspath(image_location)}|{image_stat.st_mtime_ns}|{image_stat.st_size}"
+      # Return the key
+      return hashlib.sha1(identity.encode()).hexdigest()
+#
+# Render every thumbnail variant of an image
+#
+@measure('image_encode')
+def render_thumbnails(image_location, key):
+      from PIL import Image
       # Open the image from the specified path
       image = Image.open(image_location)
-      # Set a proper thumbnail to fit in the window
-      image.thumbnail((800, 600))
-      # Create a new window
-      root = Tk()
-      # Give a title to the new window
-      root.title("Image Viewer")
-      # Make it unresizable
-      root.resizable(False, False)
-      # Select a darker theme for the window
-      root.configure(bg="#1e1e1e")
-      # Convert the PIL image to Tkinter PhotoImage
-      tk_image = ImageTk.PhotoImage(image)
-      # Create a label
-      label = Label(root, image=tk_image, bd=0, highlightthickness=0)
-      label.pack()
-      # Start the Tkinter event loop
-      root.mainloop()
+      # Let the JPEG decoder downscale while decoding instead of reading every pixel
+      image.draft('RGB', THUMBNAIL_SIZES['preview'])
+      # Thumbnails are stored as JPEG
+      image = image.convert('RGB')
+      # Count the bytes written, for the size of the cache
+      written = 0
+      # Shrink the same image step by step, from the largest variant to the smallest
+      for variant, size in THUMBNAIL_SIZES.items():
+            # Set a proper thumbnail to fit in the variant
+            image.thumbnail(size)
+            # Create the folder of the variant if not exist
+            variant_directory = os.path.join(THUMBNAIL_DIRECTORY, variant)
+            os.makedirs(variant_directory, exist_ok = True)
+            # Write next to the final file and move it into place
+            thumbnail_path = os.path.join(variant_directory, f"{key}.jpg")
+            partial_path = f"{thumbnail_path}.{threading.get_ident()}.part"
+            image.save(partial_path, 'JPEG', quality=85)
+            written += os.path.getsize(partial_path)
+            # A thumbnail rendered again replaces the bytes of the old one
+            with contextlib.suppress(FileNotFoundError):
+                  written -= os.path.getsize(thumbnail_path)
+            os.replace(partial_path, thumbnail_path)
+      # Return how much the cache grew
+      return written
+#
+# Keep the thumbnail cache within its size limit
+#
+def evict_thumbnails(written=0):
+      # Only one thread evicts at a time
+      with thumbnail_lock:
+            # The cache is only walked when it is counted for the first time or grew past its limit
+            if (thumbnail_cache['directory'] == THUMBNAIL_DIRECTORY and thumbnail_cache['size'] is not None):
+                  thumbnail_cache['size'] += written
+                  if (thumbnail_cache['size'] <= THUMBNAIL_CACHE_LIMIT):
+                        return
+            # Collect every cached thumbnail
+            thumbnails = []
+            for directory, _, filenames in os.walk(THUMBNAIL_DIRECTORY):
+                  for filename in filenames:
+                        # Skip the thumbnails that are still being written
+                        if (not filename.endswith('.jpg')):
+                              continue
+                        thumbnail_path = os.path.join(directory, filename)
+                        thumbnail_stat = os.stat(thumbnail_path)
+                        thumbnails.append((thumbnail_stat.st_mtime, thumbnail_stat.st_size, thumbnail_path))
+            # Find out how much space the cache takes
+            cache_size = sum(thumbnail[1] for thumbnail in thumbnails)
+            # A full cache is emptied below its limit, so the walks stay rare
+            target = THUMBNAIL_CACHE_LIMIT * THUMBNAIL_CACHE_TARGET if (cache_size > THUMBNAIL_CACHE_LIMIT) else THUMBNAIL_CACHE_LIMIT
+            # Remove the least recently used thumbnails first
+            for _, thumbnail_size, thumbnail_path in sorted(thumbnails):
+                  if (cache_size <= target):
+                        break
+                  with contextlib.suppress(FileNotFoundError):
+                        os.remove(thumbnail_path)
+                  cache_size -= thumbnail_size
+            # Keep counting from the real size
+            thumbnail_cache.update(directory=THUMBNAIL_DIRECTORY, size=cache_size)
+#
+# Find the cached thumbnail of an image, rendering it if needed
+#
+def get_thumbnail(image_location, variant='preview'):
+      # Find where the thumbnail is cached
+      key = thumbnail_key(image_location)
+      thumbnail_path = os.path.join(THUMBNAIL_DIRECTORY, variant, f"{key}.jpg")
+      if (os.path.exists(thumbnail_path)):
+            # Mark the thumbnail as recently used
+            os.utime(thumbnail_path)
+      else:
+            # Render every variant at once and make room for them
+            evict_thumbnails(render_thumbnails(image_location, key))
+      # Return the location of the thumbnail
+      return thumbnail_path
+#
+# Decode the preview of a stored image
+#
+@measure('image_decode')
+def decode_preview(image_location):
+      from PIL import Image
+      # Open the cached preview of the image
+      image = Image.open(get_thumbnail(image_location))
+      # Decode it now so the viewer only has to draw it
+      image.load()
+      # Return the image
+      return image
+#
+# Find the entry before or after another one, by date
+#
+def neighbour_entry(date, step):
+      # Find the neighbour in the catalog
+      entries = entries_catalog()
+      day = datetime.date.fromisoformat(date).toordinal()
+      position = bisect_right(entries['days'], day) if step > 0 else bisect_left(entries['days'], day) - 1
+      if (position < 0 or position >= len(entries['ids'])):
+            return None
+      # Only its image is read from the database
+      id = entries['ids'][position]
+      image_location = fetch_one("SELECT image_location FROM entries WHERE id=?", (id,))
+      return (id, datetime.date.fromordinal(entries['days'][position]).isoformat(), catalog_title(entries, position), image_location and image_location[0])
+#
+# Decode the neighbours of the entry on screen in the background
+#
+def prefetch_neighbours(entry):
+      # Only the image on screen and its neighbours are kept
+      keep = {entry[3]}
+      if (entry[0] is not None):
+            for step in (-1, 1):
+                  neighbour = neighbour_entry(entry[1], step)
+                  # Entries without an image are skipped by the navigation
+                  if (neighbour and neighbour[3]):
+                        keep.add(neighbour[3])
+                        # Start decoding the neighbour if not already done
+                        if (neighbour[3] not in viewer_prefetch):
+                              viewer_prefetch[neighbour[3]] = viewer['prefetcher'].submit(decode_preview, neighbour[3])
+      # Forget everything else
+      for image_location in [image_location for image_location in viewer_prefetch if image_location not in keep]:
+            del viewer_prefetch[image_location]
+#
+# Show an entry in the viewer window
+#
+@measure('viewer_show')
+def viewer_show(entry):
+      from PIL import ImageTk
+      try:
+            # Use the prefetched preview if there is one
+            future = viewer_prefetch.get(entry[3])
+            image = future.result() if future else decode_preview(entry[3])
+            # Convert the PIL image to Tkinter PhotoImage and keep a reference to it
+            tk_image = ImageTk.PhotoImage(image)
+            viewer['label'].configure(image=tk_image)
+            viewer['label'].image = tk_image
+            # Give a title to the window
+            viewer['window'].title(f"Image Viewer - {entry[1]} - {entry[2]}" if entry[0] is not None else "Image Viewer")
+            # Bring the window up
+            viewer_closed.clear()
+            viewer['window'].deiconify()
+            viewer['window'].lift()
+            viewer['entry'] = entry
+            # Get the neighbours ready for navigation
+            prefetch_neighbours(entry)
+      except Exception as e:
+            print(f"[ERROR] Unable to display image: {e}")
+#
+# Move to the previous or next entry
+#
+def viewer_navigate(step):
+      # Navigation needs an entry on screen
+      if (not viewer.get('entry') or viewer['entry'][0] is None):
+            return
+      neighbour = neighbour_entry(viewer['entry'][1], step)
+      # Skip the entries imported without their image
+      while (neighbour and not neighbour[3]):
+            neighbour = neighbour_entry(neighbour[1], step)
+      if (neighbour):
+            viewer_show(neighbour)
+#
+# Handle the requests sent to the viewer thread
+#
+def viewer_poll():
+      try:
+            while (True):
+                  image_location = viewer_queue.get_nowait()
+                  # Stop the viewer
+                  if (image_location is VIEWER_STOP):
+                        viewer['root'].quit()
+                        return
+                  # Find the entry of the image for navigation, if it has one
+                  entry = fetch_one("SELECT id, date, title, image_location FROM entries WHERE image_location=?", (str(image_location),))
+                  viewer_show(entry or (None, None, None, str(image_location)))
+      except queue.Empty:
+            pass
+      # Check again shortly
+      viewer['root'].after(50, viewer_poll)
+#
+# The image viewer thread
+#
+def viewer_loop():
+      from tkinter import Button, Frame, Label, Tk, Toplevel
+      try:
+            # Create the one Tk root of the program, hidden
+            root = Tk()
+            root.withdraw()
+            # Create the window, which is hidden instead of destroyed when closed
+            window = Toplevel(root)
+            window.title("Image Viewer")
+            # Make it unresizable
+            window.resizable(False, False)
+            # Select a darker theme for the window
+            window.configure(bg="#1e1e1e")
+            window.protocol("WM_DELETE_WINDOW", viewer_close)
+            window.withdraw()
+            # Create a label
+            label = Label(window, bd=0, highlightthickness=0)
+            label.pack()
+            # Create the navigation controls
+            controls = Frame(window, bg="#1e1e1e")
+            controls.pack(fill='x')
+            Button(controls, text="< Previous", command=lambda: viewer_navigate(-1)).pack(side='left')
+            Button(controls, text="Next >", command=lambda: viewer_navigate(1)).pack(side='right')
+            window.bind("<Left>", lambda event: viewer_navigate(-1))
+            window.bind("<Right>", lambda event: viewer_navigate(1))
+      except Exception as e:
+            print(f"[ERROR] Unable to start image viewer: {e}")
+            return
+      # The thread uses its own prefetch workers
+      viewer.update(root=root, window=window, label=label, entry=None, prefetcher=ThreadPoolExecutor(max_workers=2))
+      try:
+            # Start handling requests and the Tkinter event loop
+            viewer_poll()
+            root.mainloop()
+      finally:
+            # Release everything the thread owns
+            viewer_prefetch.clear()
+            viewer['prefetcher'].shutdown(cancel_futures=True)
+            root.destroy()
+#
+# A custom image viewer, which shows the image without blocking the caller
+#
+def image_viewer(image_location):
+      global viewer_thread
+      # Entries imported without their image have nothing to show
+      if (not image_location):
+            raise ValueError("The entry has no image.")
+      # Start the viewer thread on first use, or again if it could not start
+      if (viewer_thread is None or not viewer_thread.is_alive()):
+            viewer_thread = threading.Thread(target=viewer_loop, name="image-viewer", daemon=True)
+            viewer_thread.start()
+      # Send the image to the viewer
+      viewer_queue.put(image_location)
+#
+# Hide the viewer window when it is closed
+#
+def viewer_close():
+      viewer['window'].withdraw()
+      viewer_closed.set()
+#
+# Wait until the viewer window is closed, or the viewer stops
+#
+def wait_viewer():
+      while (viewer_thread is not None and viewer_thread.is_alive() and not viewer_closed.wait(0.5)):
+            pass
+#
+# Stop the image viewer thread
+#
+def stop_viewer():
+      if (viewer_thread is not None and viewer_thread.is_alive()):
+            viewer_queue.put(VIEWER_STOP)
+            viewer_thread.join(timeout=5)
+#
+# Shared HTTP session with a connection pool
+#
+def get_session():
+      import requests
+      global http_session
+      # Only one thread may create the session
+      with http_session_lock:
+            if (http_session is None):
+                  # Create the session
+                  http_session = requests.Session()
+                  # Keep enough pooled connections for every download worker
+                  adapter = requests.adapters.HTTPAdapter(pool_connections=BACKFILL_WORKERS, pool_maxsize=BACKFILL_WORKERS)
+                  http_session.mount('https://', adapter)
+                  http_session.mount('http://', adapter)
+      # Return the session
+      return http_session
+#
+# Refill the token bucket of a key for the time that passed (the request lock must be held)
+#
+def refill_bucket(api_key):
+      now = time.monotonic()
+      # Every key starts with a full bucket
+      rate_limit = rate_limits.setdefault(api_key, {'tokens': RATE_LIMIT_BURST, 'rate': RATE_LIMIT_PER_HOUR / 3600, 'updated': now})
+      rate_limit['tokens'] = min(RATE_LIMIT_BURST, rate_limit['tokens'] + (now - rate_limit['updated']) * rate_limit['rate'])
+      rate_limit['updated'] = now
+      return rate_limit
+#
+# Pick the key with the most requests to spare
+#
+def pick_api_key(api_keys):
+      with request_lock:
+            return max(api_keys, key=lambda api_key: refill_bucket(api_key)['tokens'])
+#
+# Wait for a token of the rate limiter of a key
+#
+def acquire_token(api_key):
+      while (True):
+            with request_lock:
+                  rate_limit = refill_bucket(api_key)
+                  # Take a token if there is one
+                  if (rate_limit['tokens'] >= 1):
+                        rate_limit['tokens'] -= 1
+                        return
+                  # Otherwise find out how long until the next one
+                  wait = (1 - rate_limit['tokens']) / rate_limit['rate']
+            # Tell the user instead of hanging when the key is used up
+            if (wait > RATE_LIMIT_MAX_WAIT):
+                  raise Exception(f"The rate limit of the API key is reached, try again in {wait / 60:.0f} minutes.")
+            if (request_stop.wait(wait)):
+                  raise Exception("Request cancelled, the program is exiting.")
+#
+# Follow the rate limit the API reports
+#
+def follow_rate_limit(api_key, response):
+      remaining = response.headers.get('X-RateLimit-Remaining')
+      if (remaining is None or not remaining.isdigit()):
+            return
+      with request_lock:
+            rate_limit = refill_bucket(api_key)
+            # Spread the remaining requests over the rest of the hour
+            rate_limit['rate'] = max(int(remaining), 1) / 3600
+            # Never hold more tokens than the API has left
+            rate_limit['tokens'] = min(rate_limit['tokens'], int(remaining))
+#
+# Record the outcome of a request on the circuit breaker
+#
+def record_request(success):
+      with request_lock:
+            if (success):
+                  circuit['failures'] = 0
+            else:
+                  circuit['failures'] += 1
+                  # Open the circuit, or open it again after a failed trial request
+                  if (circuit['failures'] >= CIRCUIT_THRESHOLD):
+                        circuit['opened'] = time.monotonic()
+#
+# Find how many seconds are left until the circuit lets requests through
+#
+def circuit_wait():
+      with request_lock:
+            if (circuit['failures'] < CIRCUIT_THRESHOLD):
+                  return 0
+            return max(0, circuit['opened'] + CIRCUIT_COOLDOWN - time.monotonic())
+#
+# Send a GET request to the NASA servers with rate limiting, timeouts and retries
+#
+def nasa_get(url, **kwargs):
+      import requests
+      # Fail fast while the servers are left alone
+      if (circuit_wait() > 0):
+            raise Exception(f"NASA servers unavailable, retrying in {circuit_wait():.0f} seconds.")
+      # Every request gets a connect and a read timeout
+      kwargs.setdefault('timeout', REQUEST_TIMEOUT)
+      for attempt in range(REQUEST_RETRIES + 1):
+            # Only the API counts against the rate limit of the key
+            api_key = kwargs.get('params', {}).get('api_key') if url == APOD_API_URL else None
+            if (api_key is not None):
+                  acquire_token(api_key)
+            retry_after = None
+            try:
+                  with measure('http_request'):
+                        response = get_session().get(url, **kwargs)
+                  count_metric('http_requests')
+                  if (api_key is not None):
+                        follow_rate_limit(api_key, response)
+                  # Hand back anything but throttling and server errors
+                  if (response.status_code not in (429, 500, 502, 503, 504)):
+                        record_request(True)
+                        return response
+                  # Honor the wait the server asks for
+                  if (response.headers.get('Retry-After', '').isdigit()):
+                        retry_after = int(response.headers['Retry-After'])
+                  response.close()
+                  failure = f"Status code: {response.status_code}"
+            except (requests.ConnectionError, requests.Timeout) as e:
+                  failure = e
+            record_request(False)
+            # Give up after the last attempt or once the circuit opens
+            if (attempt == REQUEST_RETRIES or circuit_wait() > 0):
+                  break
+            # Back off exponentially, with full jitter
+            delay = retry_after or random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+            print(f"[WARNING] Request failed ({failure}), retrying in {delay:.1f} seconds...")
+            if (request_stop.wait(delay)):
+                  break
+      raise Exception(f"Request to {url} failed: {failure}")
+#
+# Count an HTTP cache hit, miss or revalidation
+#
+def count_cache(stat):
+      with http_cache_lock:
+            cache_stats[stat] += 1
+#
+# Look up a cached response
+#
+def cache_lookup(key):
+      global http_cache
+      with http_cache_lock:
+            # Open the cache on first use
+            if (http_cache is None):
+                  os.makedirs(APOD_DIRECTORY, exist_ok = True)
+                  http_cache = sqlite3.connect(HTTP_CACHE_FILE, check_same_thread=False)
+                  # The body is the JSON payload of metadata, or the store location of images
+                  http_cache.execute("CREATE TABLE IF NOT EXISTS responses(key TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, expires REAL, body BLOB)")
+            # Return the etag, last modification, expiry and body if cached
+            return http_cache.execute("SELECT etag, last_modified, expires, body FROM responses WHERE key=?", (key,)).fetchone()
+#
+# Cache a response until the given time
+#
+def cache_store(key, response, expires, body):
+      with http_cache_lock:
+            http_cache.execute("INSERT OR REPLACE INTO responses(key, etag, last_modified, expires, body) VALUES (?, ?, ?, ?, ?)",
+                               (key, response.headers.get('ETag'), response.headers.get('Last-Modified'), expires, body))
+            http_cache.commit()
+#
+# Extend the life of a cached response the server says is unchanged
+#
+def cache_refresh(key, expires):
+      with http_cache_lock:
+            http_cache.execute("UPDATE responses SET expires=? WHERE key=?", (expires, key))
+            http_cache.commit()
+#
+# Ask the server to answer 304 if the cached response is still current
+#
+def conditional_headers(cached):
+      headers = {}
+      if (cached and cached[0]):
+            headers['If-None-Match'] = cached[0]
+      if (cached and cached[1]):
+            headers['If-Modified-Since'] = cached[1]
+      return headers
+#
+# Find when the APOD of a date can change next
+#
+def apod_expiry(date=None):
+      # Past APODs are settled
+      if (date and date < datetime.date.today().isoformat()):
+            return time.time() + ARCHIVE_CACHE_TTL
+      # Today's APOD is kept until the day changes
+      tomorrow = datetime.datetime.combine(datetime.date.today() + datetime.timedelta(days=1), datetime.time())
+      return tomorrow.timestamp()
+#
+# Find how long a response that should hold the latest APOD stays fresh, from the dates it holds
+#
+def latest_apod_expiry(body):
+      apod_data = json.loads(body)
+      dates = [entry.get('date') or "" for entry in ([apod_data] if isinstance(apod_data, dict) else apod_data)]
+      # The APOD changes day at midnight in US Eastern time, so it may still be yesterday's here
+      if (max(dates, default="") < datetime.date.today().isoformat()):
+            return time.time() + APOD_PENDING_TTL
+      # Once today's APOD is out it is kept until the day changes
+      return apod_expiry()
+#
+# GET a response body through the HTTP cache
+#
+def cached_get(url, parameters, key, expires):
+      # The expiry may depend on the body of the response
+      expiry = lambda body: expires(body) if callable(expires) else expires
+      cached = cache_lookup(key)
+      # Serve fresh responses from the cache
+      if (cached and cached[2] > time.time()):
+            count_cache('hits')
+            return 200, cached[3]
+      # Otherwise ask the server, which may answer that the cached response is still current
+      response = nasa_get(url, params=parameters, headers=conditional_headers(cached))
+      if (response.status_code == 304 and cached):
+            count_cache('revalidated')
+            cache_refresh(key, expiry(cached[3]))
+            return 200, cached[3]
+      count_cache('misses')
+      count_metric('http_bytes', len(response.content))
+      # Cache the new response
+      if (response.status_code == 200):
+            cache_store(key, response, expiry(response.content), response.content)
+      # Return the status code and the body
+      return response.status_code, response.content
+#
+# Fetch an image into the store through the HTTP cache
+#
+def fetch_image(url):
+      cached = cache_lookup(url)
+      # The cache only helps if the stored image is still there
+      if (cached and not os.path.exists(cached[3])):
+            cached = None
+      # Serve fresh images from the store
+      if (cached and cached[2] > time.time()):
+            count_cache('hits')
+            return Path(cached[3])
+      # Otherwise ask the server, which may answer that the stored image is still current
+      image_response = nasa_get(url, stream=True, headers=conditional_headers(cached))
+      if (image_response.status_code == 304 and cached):
+            image_response.close()
+            count_cache('revalidated')
+            cache_refresh(url, time.time() + ARCHIVE_CACHE_TTL)
+            return Path(cached[3])
+      count_cache('misses')
+      # Fail if the image could not be fetched
+      if (image_response.status_code != 200):
+            image_response.close()
+            raise Exception(f"Unable to fetch APOD image. Status code: {image_response.status_code}")
+      # Save the image in the store and remember where it is
+      new_image_path = store_image(image_response)
+      cache_store(url, image_response, time.time() + ARCHIVE_CACHE_TTL, str(new_image_path))
+      # Return the location of the image
+      return new_image_path
 #
 # Fetch the APOD data in a JSON format
 #
-def get_apod(api_key):
-      # The API calls the following url
-      url = f'https://api.nasa.gov/planetary/apod?api_key={api_key}'
+@measure('get_apod')
+def get_apod(api_key, start_date=None, end_date=None):
+      # The API is called with the key, and asked for the thumbnails of videos
+      parameters = {'api_key': api_key, 'thumbs': 'true'}
+      # Ask for a whole window of dates at once if requested
+      if (start_date):
+            parameters['start_date'] = start_date
+            # Without an end date the API stops at its own today
+            if (end_date):
+                  parameters['end_date'] = end_date
+      # The cache is shared by every key and keyed on the requested dates
+      if (start_date):
+            key = f"apod:thumbs:{start_date}:{end_date or ''}"
+            # A window reaching today may not hold today's APOD yet
+            expires = apod_expiry(end_date) if (end_date and end_date < datetime.date.today().isoformat()) else latest_apod_expiry
+      else:
+            key = f"apod:thumbs:{datetime.date.today().isoformat()}"
+            expires = latest_apod_expiry
       # Store the response
-      response = requests.get(url)
-      if (response.status_code == 200):
+      status_code, body = cached_get(APOD_API_URL, parameters, key, expires)
+      if (status_code == 200):
             # Return the JSON data
-            return response.json()
+            return json.loads(body)
       else:
-            print(f"[ERROR] Unable to fetch APOD data. Status code: {response.status_code}")
+            print(f"[ERROR] Unable to fetch APOD data. Status code: {status_code}")
 #
 # APOD data handling
 #
@@ -99,103 +906,268 @@ def display_apod(apod_data):
       # Fetch the APOD data from the JSON and assign them to variables
       title = apod_data['title']
       explanation = apod_data['explanation']
-      url = apod_data['url'] # Store the url of the image data
+      # The standard image is enough on screen, and videos only have a thumbnail
+      urls = media_urls(apod_data, hd=False)
 
       # Diplay in the terminal the collected data
       print(f"Title: {title}")
       print(f"Explanation: {explanation}")
+      if (apod_data.get('media_type', 'image') != 'image'):
+            print(f"Video: {apod_data['url']}")
 
       # Store the image
       try:
-            # Fetch the APOD image 
-            image_response = requests.get(url)
-            if (image_response.status_code == 200):
-                  # Convert the contents of the responded image to a readable format
-                  image = Image.open(BytesIO(image_response.content))
-                  try:
-                        # Show up image
-                        image_viewer(image)
-                        # Inform the user about the image
-                        print("[INFO] Image opened successfully.")
-                  except Exception as e:
-                        print(f"[ERROR] Unable to display image.: {e}")
-            else:
-                  print(f"[ERROR] Unable to fetch APOD image. Status code: {image_response.status_code}")
-      
-      except Exception as e:
-            print(f"[ERROR] Unable to receive response: {e}")
-#
-# Search for an entry (NEEDS MULTIPLE FIXES)
-#
-def search(search_request):
-      # Tell cursor to execute a SEARCH query
-      try:
-            result = cursor.execute(f"SELECT * FROM entries WHERE title LIKE '{search_request}%'")
-            # Try to retrieve image properties
-            id, title, explanation, image_location, date = result.fetchone()
-            # Display the information
-            print(f"""\n[INFO] Entry found:
-\nEntry ID: {id}
-\nDate added: {date}
-\nTitle: {title}
-\nExplanation: {explanation}\n""")
+            if (not urls):
+                  raise ValueError(f"No image for media type {apod_data.get('media_type')}")
+            # Fetch the APOD image into the store, at most once
+            image_location = fetch_image(urls[0])
             try:
                   # Show up image
                   image_viewer(image_location)
                   # Inform the user about the image
                   print("[INFO] Image opened successfully.")
             except Exception as e:
-                  print(f"[ERROR] Unable to display image: {e}")
+                  print(f"[ERROR] Unable to display image.: {e}")
+      except Exception as e:
+            print(f"[ERROR] Unable to receive response: {e}")
+#
+# Turn the words of a search request into a full-text query
+#
+def search_query(search_request):
+      # Match every word, and any word that starts with it
+      return " ".join(f'"{word}"*' for word in re.findall(r"\w+", search_request))
+#
+# Search the index for a page of entries
+#
+def search_entries(query, page=1):
+      # Rank titles above explanations and fetch one extra row to know if there are more pages
+      return fetch_all("""SELECT entries.id, entries.title, entries.date, entries.image_location,
+                  snippet(entries_search, -1, '[', ']', '...', 12)
+            FROM entries_search JOIN entries ON entries.id = entries_search.rowid
+            WHERE entries_search MATCH ?
+            ORDER BY bm25(entries_search, 10.0, 1.0)
+            LIMIT ? OFFSET ?""", (query, SEARCH_PAGE_SIZE + 1, (page - 1) * SEARCH_PAGE_SIZE))
+#
+# Search for entries
+#
+@measure('search')
+def search(search_request, page=1, show_image=True):
+      # Execute a SEARCH query
+      try:
+            query = search_query(search_request)
+            if (not query):
+                  print("[ERROR] Nothing to search for.")
+                  return False
+            entries = search_entries(query, page)
+            if (not entries):
+                  print("[INFO] No entries found.")
+                  return False
+            # Display the page of results
+            print(f"\n[INFO] Entries found (page {page}):")
+            for id, title, date, image_location, snippet in entries[:SEARCH_PAGE_SIZE]:
+                  print(f"\n    {id}      {date}      {title}\n          {snippet}")
+            # Show up the image of the best match
+            if (page == 1 and show_image):
+                  try:
+                        # Show up image
+                        image_viewer(entries[0][3])
+                        # Inform the user about the image
+                        print("[INFO] Image opened successfully.")
+                  except Exception as e:
+                        print(f"[ERROR] Unable to display image: {e}")
+            # Tell the caller if there is another page
+            return len(entries) > SEARCH_PAGE_SIZE
       except Exception as e:
             print(f"[ERROR] Unable to locate entry: {e}")
+            return False
 #
 # Delete a specific entry
 #
 def delete(delete_request):
       # Delete an entry
       try:
-            # Try to remove the spacified entry
-            cursor.execute(f"DELETE FROM entries WHERE id={delete_request}")
-            print("[INFO] Commiting changes...")
-            # Commit chages
-            database.commit()
-            print("[INFO] Entry removal completed successfully.")
+            # Try to remove the spacified entry, the transaction commits when done
+            with transaction() as connection:
+                  deleted = connection.execute("DELETE FROM entries WHERE id=?", (delete_request,)).rowcount
+            if (deleted):
+                  print("[INFO] Entry removal completed successfully.")
+            else:
+                  print(f"[ERROR] No entry with ID {delete_request}.")
       except Exception as e:
-            # Warn user with a relative message
+            # Warn user with a relative message, the transaction has reversed possible changes
             print(f"[ERROR] Unable to delete entry: {e}")
-            print("[INFO] Reversing possible changes...")
-            # Reverse possible changes caused by incomplete statement
-            database.rollback()
+#
+# Read the sorting and output options of a listing
+#
+def list_options(arguments):
+      # By default list by date, oldest first, as a table
+      options = {'sort_key': 'date', 'descending': False, 'as_json': False, 'page_size': LIST_PAGE_SIZE}
+      arguments = iter(arguments)
+      for argument in arguments:
+            argument = argument.lower()
+            if (argument in SORT_COLUMNS):
+                  options['sort_key'] = argument
+            elif (argument in ('asc', 'desc')):
+                  options['descending'] = argument == 'desc'
+            elif (argument == '--json'):
+                  options['as_json'] = True
+            elif (argument == '--page-size'):
+                  options['page_size'] = max(1, int(next(arguments)))
+            else:
+                  raise ValueError(f"Unknown option '{argument}'")
+      return options
+#
+# Find the file the catalog is saved to, next to the database
+#
+def catalog_path():
+      return os.path.splitext(database_path)[0] + ".catalog"
+#
+# Split a saved catalog into its columns, without copying them
+#
+def catalog_columns(data, version):
+      header = array('q')
+      header.frombytes(data[8:32])
+      # A catalog of another database, of another version, or of another program, is of no use
+      if (data[:8] != CATALOG_MAGIC or tuple(header[:2]) != version):
+            return None
+      count = header[2]
+      columns = memoryview(data)
+      ids = columns[32:32 + 8 * count].cast('q')
+      days = columns[32 + 8 * count:32 + 16 * count].cast('q')
+      offsets = columns[32 + 16 * count:40 + 24 * count].cast('q')
+      return {'ids': ids, 'days': days, 'offsets': offsets, 'titles': columns[40 + 24 * count:], 'orders': {'date': range(count)}}
+#
+# Read the catalog from the database and save it for the next start
+#
+def build_catalog(version):
+      # Only the covering index is read, never the explanations
+      rows = fetch_all("SELECT id, CAST(julianday(date) - 1721424.5 AS INTEGER), title FROM entries ORDER BY date")
+      titles = bytearray()
+      offsets = array('q', [0])
+      for row in rows:
+            titles += (row[2] or "").encode()
+            offsets.append(len(titles))
+      data = b"".join([CATALOG_MAGIC, array('q', [*version, len(rows)]).tobytes(), array('q', [row[0] for row in rows]).tobytes(),
+                       array('q', [row[1] for row in rows]).tobytes(), offsets.tobytes(), titles])
+      # Replace the saved catalog at once, a failure only costs the next start some time
+      try:
+            with open(catalog_path() + ".part", "wb") as catalog_file:
+                  catalog_file.write(data)
+            os.replace(catalog_path() + ".part", catalog_path())
+      except OSError as e:
+            print(f"[WARNING] Unable to save the catalog: {e}")
+      return catalog_columns(data, version)
+#
+# Get the catalog of the entries, loading it again when they changed
+#
+def entries_catalog():
+      with catalog_lock:
+            # The identity tells databases apart, the version tells if the entries changed
+            version = tuple(fetch_one("SELECT identity, version FROM entries_version"))
+            if (catalog['version'] != version):
+                  entries = None
+                  # Start from the saved catalog if it is current
+                  try:
+                        with open(catalog_path(), "rb") as catalog_file:
+                              entries = catalog_columns(catalog_file.read(), version)
+                  except (OSError, ValueError, TypeError):
+                        # A missing or damaged file is built again
+                        pass
+                  catalog['entries'] = entries or build_catalog(version)
+                  catalog['version'] = version
+            return catalog['entries']
+#
+# Decode the title of an entry of the catalog
+#
+def catalog_title(entries, position):
+      offsets = entries['offsets']
+      return str(entries['titles'][offsets[position]:offsets[position + 1]], 'utf-8')
+#
+# Find the order of the catalog by a sort key, with the ID breaking ties
+#
+def catalog_order(entries, sort_key):
+      with catalog_lock:
+            if (sort_key not in entries['orders']):
+                  ids = entries['ids']
+                  if (sort_key == 'id'):
+                        entries['orders'][sort_key] = sorted(range(len(ids)), key=ids.__getitem__)
+                  else:
+                        # UTF-8 bytes sort in the same order as SQLite compares the titles
+                        titles, offsets = entries['titles'], entries['offsets']
+                        entries['orders'][sort_key] = sorted(range(len(ids)), key=lambda position: (titles[offsets[position]:offsets[position + 1]].tobytes(), ids[position]))
+            return entries['orders'][sort_key]
+#
+# Read the entries one page at a time from the catalog
+#
+def list_pages(sort_key='date', descending=False, page_size=LIST_PAGE_SIZE):
+      entries = entries_catalog()
+      order = catalog_order(entries, sort_key)
+      if (descending):
+            order = order[::-1]
+      # Only the titles on the page are decoded
+      for first in range(0, len(order), page_size):
+            yield catalog_rows(entries, order[first:first + page_size])
+#
+# Decode the catalog rows at some positions
+#
+def catalog_rows(entries, positions):
+      ids, days = entries['ids'], entries['days']
+      return [(datetime.date.fromordinal(days[position]).isoformat(), catalog_title(entries, position), ids[position])
+              for position in positions]
+#
+# Read a single page of the catalog
+#
+def catalog_page(sort_key='date', descending=False, first=0, count=LIST_PAGE_SIZE):
+      entries = entries_catalog()
+      order = catalog_order(entries, sort_key)
+      if (not descending):
+            return catalog_rows(entries, order[first:first + count])
+      # Slice from the end instead of reversing the whole order
+      last = max(len(order) - first, 0)
+      return catalog_rows(entries, order[max(last - count, 0):last][::-1])
 #
 # Sort the entries
 #
 def sort():
-      pass
+      # Ask user how to sort the entries
+      print(f"[INFO] Sort by {', '.join(SORT_COLUMNS)} and order (asc or desc), e.g. 'title desc'.")
+      sort_request = str(input(": ")).lower().split()
+      # List the entries in that order
+      list(sort_request)
 #
 # List all entries
 #
-def list():
-      # Store all entries
-      entries = cursor.execute("SELECT id, title, date FROM entries")
+def list(arguments=(), paged=True):
+      try:
+            options = list_options(arguments)
+      except Exception as e:
+            print(f"[ERROR] Unable to list entries: {e}")
+            return
+      pages = list_pages(options['sort_key'], options['descending'], options['page_size'])
+      # Stream every entry as a line of JSON for other tools, a page at a time
+      if (options['as_json']):
+            for entries in pages:
+                  print("\n".join(json.dumps({'id': id, 'date': date, 'title': title}) for date, title, id in entries))
+                  sys.stdout.flush()
+            return
       # Interface
       print("\nEntries: ")
-      # List all available entries
-      for entry in entries:
-            # Print all entries
-            print(f"    {entry[0]}      {entry[2]}      {entry[1]}")
+      for entries in pages:
+            # List the page of entries
+            print("\n".join(f"    {id}      {date}      {title}" for date, title, id in entries))
+            # Ask user if the next page should be shown
+            if (paged and len(entries) == options['page_size']):
+                  if (str(input("[INFO] Press ENTER for the next page or type anything to stop: ")) != ""):
+                        break
 #
 # View the current APOD
 #
 def apod():
       # Try to fetch the API Key from a local txt file
       try:
-            # Read the API from file
-            api_request = open("NASA_API_KEY.txt", "rt")
+            # Read the first key of the file, without its newline
+            api_key = read_api_key()
             print("NASA_API_KEY Found!")
-            # Convert the opened file as text
-            api_key = api_request.read()
-            # Close file
-            api_request.close()
             # Utilize the api_key for apod data.
             apod_data = get_apod(api_key)
             # Send the APOD data to display if possible
@@ -212,15 +1184,18 @@ def apod():
 def view(view_request):
       # Seek he entry into the database
       try:
-            result = cursor.execute(f"SELECT * FROM entries WHERE id={view_request}")
+            result = fetch_one("SELECT id, title, explanation, image_location, date, media_type, url FROM entries WHERE id=?", (view_request,))
             # Try to retrieve image properties
-            id, title, explanation, image_location, date = result.fetchone()
+            id, title, explanation, image_location, date, media_type, url = result
             # Display the information
             print(f"""\n[INFO] Entry found:
 \nEntry ID: {id}
-\nDate added: {date}
+\nDate: {date}
 \nTitle: {title}
 \nExplanation: {explanation}\n""")
+            # Videos are only shown as their thumbnail
+            if (media_type != 'image'):
+                  print(f"Video: {url}\n")
             try:
                   # Show up image
                   image_viewer(image_location)
@@ -237,109 +1212,679 @@ def clear():
       # Clear the terminal
       os.system("cls")
 #
+# Read the API key from the local txt file
+#
+def read_api_key():
+      # The first key of the file
+      return read_api_keys()[0]
+#
+# Read every API key, one per line, to spread the requests of a shared archive over
+#
+def read_api_keys():
+      # Read the API from file
+      with open("NASA_API_KEY.txt", "rt") as api_request:
+            # Convert the opened file as text
+            api_keys = [line.strip() for line in api_request if line.strip()]
+      if (not api_keys):
+            raise ValueError("NASA_API_KEY.txt holds no key")
+      return api_keys
+#
+# Make a key the first one of the local txt file, keeping the other keys after it
+#
+def write_api_key(api_key):
+      try:
+            api_keys = [key for key in read_api_keys() if key != api_key]
+      except (OSError, ValueError):
+            api_keys = []
+      # Replace the file at once, so a failure never loses the keys
+      with open("NASA_API_KEY.txt.part", "wt") as api_file:
+            api_file.write("\n".join([api_key] + api_keys) + "\n")
+      os.replace("NASA_API_KEY.txt.part", "NASA_API_KEY.txt")
+#
+# Find the extension of a downloaded image
+#
+def image_extension(image_response):
+      # Prefer the extension of the content type sent by the server
+      content_type = image_response.headers.get('Content-Type', '').split(';')[0].strip()
+      extension = mimetypes.guess_extension(content_type) if content_type else None
+      # Otherwise fall back to the extension of the url
+      if (not extension):
+            extension = os.path.splitext(image_response.url.split('?')[0])[1] or '.bin'
+      # Keep the common spelling for JPEG files
+      return '.jpg' if extension in ('.jpe', '.jpeg') else extension.lower()
+#
+# Save a stream of image bytes in the content-addressed store
+#
+def store_chunks(chunks, extension):
+      # Create the store if not exist
+      os.makedirs(STORE_DIRECTORY, exist_ok = True)
+      # Hash the image while it is written to a temporary file in the store
+      digest = hashlib.sha256()
+      temporary_file = tempfile.NamedTemporaryFile(dir=STORE_DIRECTORY, suffix='.part', delete=False)
+      try:
+            with temporary_file:
+                  # Write the original bytes straight from the stream
+                  with measure('disk_write'):
+                        for chunk in chunks:
+                              digest.update(chunk)
+                              temporary_file.write(chunk)
+                              count_metric('disk_write_bytes', len(chunk))
+            # Name the image after the hash of its contents
+            image_hash = digest.hexdigest()
+            # Shard the store so no folder grows too large
+            shard_directory = os.path.join(STORE_DIRECTORY, image_hash[:2], image_hash[2:4])
+            os.makedirs(shard_directory, exist_ok = True)
+            new_image_path = Path(shard_directory, image_hash + extension)
+            # Identical images are only stored once
+            if (not new_image_path.exists()):
+                  # Move the image into place
+                  os.replace(temporary_file.name, new_image_path)
+                  print(f"[INFO] Image saved. Path: {new_image_path}")
+            else:
+                  print(f"[INFO] Image already stored. Path: {new_image_path}")
+      finally:
+            # Remove the temporary file if it was not moved into place
+            if (os.path.exists(temporary_file.name)):
+                  os.remove(temporary_file.name)
+      # Return the location of the image
+      return new_image_path
+#
+# Save a downloaded APOD image in the content-addressed store
+#
+def store_image(image_response):
+      try:
+            # Write the original bytes straight from the response stream
+            return store_chunks(image_response.iter_content(CHUNK_SIZE), image_extension(image_response))
+      finally:
+            # Hand the connection back to the pool
+            image_response.close()
+#
+# Find the SHA-256 checksum of an image
+#
+def image_checksum(image_location):
+      # Images in the store are named after their checksum
+      image_location = Path(image_location)
+      if (image_location.parent.parent.parent == Path(STORE_DIRECTORY) and re.fullmatch(r"[0-9a-f]{64}", image_location.stem)):
+            return image_location.stem
+      # Otherwise read the image one chunk at a time
+      digest = hashlib.sha256()
+      with open(image_location, "rb") as image_file:
+            for chunk in iter(lambda: image_file.read(CHUNK_SIZE), b""):
+                  digest.update(chunk)
+      return digest.hexdigest()
+#
+# Insert an entry, or refresh the existing entry of the same date only if something changed
+#
+ENTRY_UPSERT = """INSERT INTO entries(date, title, explanation, url, image_location, added, phash, media_type, image_url)
+      VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+      ON CONFLICT(date) DO UPDATE SET title=excluded.title, explanation=excluded.explanation, url=excluded.url,
+            image_location=excluded.image_location, phash=excluded.phash, media_type=excluded.media_type, image_url=excluded.image_url
+      WHERE (title, explanation, url, image_location, phash, media_type, image_url) IS NOT
+            (excluded.title, excluded.explanation, excluded.url, excluded.image_location, excluded.phash, excluded.media_type, excluded.image_url)"""
+#
+# Create the properties of a new entry
+#
+def entry_row(apod_data, image_location, phash=None, image_url=None):
+      return (apod_data['date'], apod_data['title'], apod_data['explanation'], apod_data['url'],
+              str(image_location), datetime.datetime.now().isoformat(timespec='seconds'), phash,
+              apod_data.get('media_type', 'image'), image_url)
+#
+# Store new entries on the database, within the transaction of the given connection, and return the dates left out
+#
+def create_entries(connection, rows):
+      try:
+            connection.executemany(ENTRY_UPSERT, rows)
+            return []
+      except sqlite3.IntegrityError:
+            # An image featured again under its old URL conflicts with the entry of its first date,
+            # so the batch is written again one row at a time and the conflicting dates are left out
+            rejected = []
+            for row in rows:
+                  try:
+                        connection.execute(ENTRY_UPSERT, row)
+                  except sqlite3.IntegrityError as e:
+                        print(f"[WARNING] Skipping {row[0]}: {e}")
+                        rejected.append(row[0])
+            # Return the dates that were not stored
+            return rejected
+#
+# Get a newly stored image ready: render its thumbnails and hash it
+#
+def prepare_image(image_location):
+      # Pre-render the thumbnails of the new image
+      try:
+            get_thumbnail(image_location)
+      except Exception as e:
+            print(f"[WARNING] Unable to render thumbnails: {e}")
+      # Hash the image for the similarity search
+      try:
+            return image_hash(image_location)
+      except Exception as e:
+            print(f"[WARNING] Unable to hash image: {e}")
+            return None
+#
+# Find the images that can be stored for an entry, best first
+#
+def media_urls(apod_data, hd=INGEST_HD):
+      # Images come in a standard and, often, a high resolution
+      if (apod_data.get('media_type', 'image') == 'image'):
+            return [url for url in (apod_data.get('hdurl') if hd else None, apod_data.get('url')) if url]
+      # Videos and other media only have the thumbnail the API was asked for, if any
+      return [apod_data['thumbnail_url']] if apod_data.get('thumbnail_url') else []
+#
+# Check that a stored file is an image, reading only its header
+#
+def validate_image(image_location):
+      from PIL import Image
+      with Image.open(image_location) as image:
+            if (not image.width or not image.height):
+                  raise ValueError(f"Empty {image.format} image")
+#
+# Ingestion stage: download the best image of an entry into the store
+#
+def ingest_download(task):
+      # Slow down instead of failing while the NASA servers are left alone
+      while (circuit_wait() > 0):
+            if (request_stop.wait(circuit_wait())):
+                  raise Exception("Download cancelled, the program is exiting.")
+      # Fall back to the next image if one cannot be fetched
+      while (True):
+            task['image_url'] = task['urls'].pop(0)
+            try:
+                  task['image_location'] = fetch_image(task['image_url'])
+                  return task
+            except Exception as e:
+                  if (not task['urls']):
+                        raise
+                  print(f"[WARNING] Unable to fetch {task['image_url']}, trying the next image: {e}")
+#
+# Ingestion stage: validate the downloaded image, then render its thumbnails and hash it
+#
+def ingest_decode(task):
+      while (True):
+            try:
+                  validate_image(task['image_location'])
+                  break
+            except Exception as e:
+                  # A broken high-resolution image still leaves the standard one
+                  if (not task['urls']):
+                        raise ValueError(f"{task['image_url']} is not an image: {e}")
+                  print(f"[WARNING] {task['image_url']} is not an image, trying the next one.")
+                  ingest_download(task)
+      task['phash'] = prepare_image(task['image_location'])
+      return task
+#
+# Run the tasks of a queue through an ingestion stage until it is told to stop
+#
+def ingest_worker(stage, tasks, results, stop_event):
+      while (True):
+            task = tasks.get()
+            if (task is None):
+                  return
+            # Drop the rest of the work when asked to stop, it is picked up next time
+            if (stop_event is not None and stop_event.is_set()):
+                  continue
+            try:
+                  results.put(stage(task))
+            except Exception as e:
+                  print(f"[ERROR] Unable to ingest {task['apod_data']['date']}: {e}")
+#
+# Write the ingested entries and the skipped dates in batches, as soon as they arrive
+#
+def ingest_writer(results):
+      finished_entries, skipped_dates = [], []
+      while (True):
+            try:
+                  # Wait a little for more before writing what has arrived
+                  task = results.get(timeout=0.5 if finished_entries or skipped_dates else None)
+                  if (task is not None):
+                        if (task.get('image_location')):
+                              finished_entries.append((task['apod_data'], task['image_location'], task['phash'], task['image_url']))
+                              print(f"[INFO] Downloaded {task['apod_data']['date']}: {task['apod_data']['title']}")
+                        else:
+                              skipped_dates.append(task['apod_data']['date'])
+                        # Keep collecting until the batch is full
+                        if (len(finished_entries) + len(skipped_dates) < BACKFILL_BATCH):
+                              continue
+            except queue.Empty:
+                  pass
+            try:
+                  save_backfill(finished_entries, skipped_dates)
+            except Exception as e:
+                  print(f"[ERROR] Unable to save entries: {e}")
+            finished_entries, skipped_dates = [], []
+            # Stop once every stage is done
+            if (task is None):
+                  return
+#
+# Ingest APOD entries through a pipeline of stages: classify, download, decode and persist.
+# Each stage has its own workers and hands its work on through a bounded queue, so entries
+# without an image are written without waiting for the downloads of the others.
+#
+def ingest(apod_window, stop_event=None):
+      downloads = queue.Queue(INGEST_QUEUE_SIZE)
+      decodes = queue.Queue(INGEST_QUEUE_SIZE)
+      results = queue.Queue(INGEST_QUEUE_SIZE)
+      stages = [(ingest_download, downloads, decodes, BACKFILL_WORKERS), (ingest_decode, decodes, results, DECODE_WORKERS)]
+      workers = [[threading.Thread(target=ingest_worker, args=(stage, tasks, stage_results, stop_event), name=f"{stage.__name__}-{number}", daemon=True)
+                  for number in range(count)] for stage, tasks, stage_results, count in stages]
+      writer = threading.Thread(target=ingest_writer, args=(results,), name="ingest_writer", daemon=True)
+      for worker in [writer] + workers[0] + workers[1]:
+            worker.start()
+      try:
+            # Classify every entry by the images it has to offer
+            for apod_data in apod_window:
+                  if (stop_event is not None and stop_event.is_set()):
+                        print("[INFO] Ingestion interrupted.")
+                        break
+                  urls = media_urls(apod_data)
+                  if (urls):
+                        downloads.put({'apod_data': apod_data, 'urls': urls})
+                  else:
+                        # Nothing to download, the date is done
+                        print(f"[WARNING] Skipping {apod_data['date']}: no image for media type {apod_data.get('media_type')}.")
+                        results.put({'apod_data': apod_data})
+      finally:
+            # Let each stage finish its queue before telling the next one to stop
+            for (stage, tasks, stage_results, count), stage_workers in zip(stages, workers):
+                  for _ in stage_workers:
+                        tasks.put(None)
+                  for worker in stage_workers:
+                        worker.join()
+            results.put(None)
+            writer.join()
+#
 # Update the database
 #
+@measure('update')
 def update():
       # Try to fetch the API Key from a local txt file
       try:
             print("[INFO] Updating database...")
             # Read the API from file
-            api_request = open("NASA_API_KEY.txt", "rt")
+            api_key = read_api_key()
             print("[INFO] NASA_API_KEY Found.")
-            # Convert the opened file as text
-            api_key = api_request.read()
-            # Close file
-            api_request.close()
             # Utilize the api_key for apod data.
             apod_data = get_apod(api_key)
             # Send the APOD data to display if possible
             if (apod_data):
-                  # Fetch the APOD data from the JSON and assign them to variables
-                  while (True):
-                        # Assign random ID number to entry
-                        id = random.randint(0, 1000) # Missing conflict checks
-                        # Search for it in the database
-                        id_conflict = cursor.execute(f"SELECT id FROM entries WHERE id={id}")
-                        # Check if there is ID conflict
-                        if (id_conflict.fetchone()):
-                              # Continue to generate a random number
-                              continue
-                        else:
-                              # If not break the loop
-                              break
-                  title = apod_data['title']
-                  explanation = apod_data['explanation']
-                  url = apod_data['url'] # Store the url of the image data
-                  date = datetime.datetime.now().strftime("%d/%m/%Y - %X")
-                  # Store the image
-                  try:
-                        # Fetch the APOD image
-                        image_response = requests.get(url)
-                        if (image_response.status_code == 200):
-                              # Convert the contents of the responded image to a readable format
-                              image = Image.open(BytesIO(image_response.content))
-                              
-                              ### Saving Procedure ###
-                              # Create a new empty image
-                              new_image = Image.new('RGB', (image.width, image.height), color = 'white')
-                              # Paste the APOD image onto the new empty canvas
-                              new_image.paste(image, (0, 0))
-                              # Define the HOME directory of the user
-                              home_directory = os.path.expanduser("~")
-                              # Define the Pictures directory of the user
-                              apod_directory = os.path.join(home_directory, 'Pictures', 'Space', 'APOD')
-                              # Create it if not exist
-                              os.makedirs(apod_directory, exist_ok = True)
-                              # Name the new image after it's title
-                              new_image_filename = f"{title}.png"
-                              # Forge the new directory of the APOD folder and the filename
-                              new_image_path = os.path.join(apod_directory, new_image_filename)
-                              # Convert to Path
-                              new_image_path = Path(new_image_path)
-                              # Save the image
-                              if (not new_image_path.exists()):
-                                    # Save the image
-                                    new_image.save(new_image_path)
-                                    print(f"[INFO] Image saved. Path: {new_image_path}")
-                              else:
-                                    print(f"[WARNING] Unable to save new image because it already exists.")
-                              ### End of Saving Procedure ###
-                                    
-                              # Store on database along with title, explanation e.t.c.
-                              print(f"[INFO] Creating a new entry...")
-                              # Create the new entry properties
-                              new_entry_properties = [title, id, explanation, str(new_image_path), date]
-                              try:
-                                    # Check if entry exists
-                                    exists = cursor.execute(f"SELECT title FROM entries WHERE title='{title}'")
-                                    # Select from result set
-                                    exists = cursor.fetchone()
-                                    # Fetch current entry if exists
-                                    #if (not os.path.exists(f"{new_image_path}")):
-                                          # Execute the query
-                                    cursor.execute(f"INSERT INTO entries(title, id, explanation, image_location, date) VALUES (?, ?, ?, ?, ?)", new_entry_properties)
-                                    #else:
-                                          # Warn user
-                                    #      print("[INFO] Current entry already exists.")
-                              except Exception as e:
-                                    print(f"[ERROR] Unable to create entry: {e}")
-                              
-                              # Inform user about change commits
-                              print("[INFO] Commiting changes...")
-                              # Commit changes
-                              database.commit()
-                              # Inform user about the successfull operation
-                              print(f"[INFO] Entry added successfully.")
-                              
-                        else:
-                              print(f"[ERROR] Unable to fetch APOD image. Status code: {image_response.status_code}")
-                  except Exception as e:
-                        print(f"[ERROR] Unable to receive response: {e}")
+                  # Nothing to do if the entry of the day is already stored
+                  if (fetch_one("SELECT id FROM entries WHERE date=?", (apod_data['date'],))):
+                        print(f"[INFO] The entry of {apod_data['date']} already exists.")
+                        return
+                  # Store the image and the entry along with title, explanation e.t.c.
+                  print(f"[INFO] Creating a new entry...")
+                  ingest([apod_data])
             else:
                   print(f"[ERROR]: Unable to display APOD data: {apod_data}")
       except Exception as e:
             print(f"[ERROR] Unable to read NASA_API_KEY: {e}")
 #
+# Write a batch of ingested entries and the progress of their dates in one transaction
+#
+def save_backfill(finished_entries, skipped_dates):
+      # Warn about images already in the archive under another date
+      flag_near_duplicates([(apod_data['date'], phash) for apod_data, _, phash, _ in finished_entries])
+      with transaction() as connection:
+            rejected = set(create_entries(connection, [entry_row(*finished_entry) for finished_entry in finished_entries]))
+            # Dates that could not be stored are skipped, so later backfills do not retry them
+            connection.executemany("INSERT OR REPLACE INTO backfill_progress(date, status) VALUES (?, ?)",
+                                   [(apod_data['date'], 'skipped' if apod_data['date'] in rejected else 'done') for apod_data, _, _, _ in finished_entries] +
+                                   [(date, 'skipped') for date in skipped_dates])
+      if (finished_entries):
+            print(f"[INFO] Saved {len(finished_entries) - len(rejected)} entries.")
+#
+# Fill the database with every APOD between two dates
+#
+def backfill(start_date, end_date=None, stop_event=None):
+      try:
+            print("[INFO] Backfilling database...")
+            # Read the API from file
+            api_key = read_api_key()
+            # Keep track of the finished dates so an interrupted backfill can resume
+            finished = {row[0] for row in fetch_all("SELECT date FROM backfill_progress UNION SELECT date FROM entries")}
+            # Fetch the metadata of the whole window with a single request
+            apod_window = get_apod(api_key, start_date, end_date)
+            if (apod_window is None):
+                  print("[ERROR] Unable to fetch the APOD window.")
+                  return
+            # Leave out the dates that are already done
+            pending = [apod_data for apod_data in apod_window if apod_data['date'] not in finished]
+            print(f"[INFO] {len(apod_window) - len(pending)} dates already done, {len(pending)} remaining.")
+            # Run them through the ingestion pipeline
+            ingest(pending, stop_event)
+            print("[INFO] Backfill complete.")
+      except Exception as e:
+            print(f"[ERROR] Unable to backfill database: {e}")
+#
+# Export the archive as a single tar file with a JSON-lines manifest
+#
+def export_archive(archive_path):
+      import tarfile
+      try:
+            print("[INFO] Exporting archive...")
+            # The manifest may be large, so it spills to disk
+            manifest = tempfile.SpooledTemporaryFile(max_size=CHUNK_SIZE * 16)
+            # The images to pack, one per checksum
+            images = {}
+            with database_connection() as connection:
+                  rows = connection.execute("""SELECT id, date, title, explanation, url, image_location, added, media_type, image_url
+                        FROM entries ORDER BY date""")
+                  for id, date, title, explanation, url, image_location, added, media_type, image_url in rows:
+                        # Describe the image of the entry by its checksum
+                        image = None
+                        if (image_location and os.path.exists(image_location)):
+                              checksum = image_checksum(image_location)
+                              image = f"images/{checksum}{Path(image_location).suffix.lower()}"
+                              images[image] = image_location
+                        else:
+                              print(f"[WARNING] The image of {date} is missing, exporting the entry without it.")
+                        manifest.write((json.dumps({'date': date, 'title': title, 'explanation': explanation, 'url': url, 'added': added,
+                                                    'media_type': media_type, 'image_url': image_url, 'image': image}) + "\n").encode())
+            # Compress the archive if its name asks for it
+            mode = "w|gz" if archive_path.endswith((".gz", ".tgz")) else "w|"
+            with tarfile.open(archive_path, mode) as archive:
+                  # The manifest comes first, so an import knows the entries before the images
+                  manifest_info = tarfile.TarInfo("manifest.jsonl")
+                  manifest_info.size = manifest.tell()
+                  manifest_info.mtime = int(time.time())
+                  manifest.seek(0)
+                  archive.addfile(manifest_info, manifest)
+                  # Then stream every image from disk, one at a time
+                  for image, image_location in images.items():
+                        image_info = archive.gettarinfo(image_location, arcname=image)
+                        with open(image_location, "rb") as image_file:
+                              archive.addfile(image_info, image_file)
+            manifest.close()
+            print(f"[INFO] Exported {len(images)} images to {archive_path}.")
+      except Exception as e:
+            print(f"[ERROR] Unable to export archive: {e}")
+#
+# Import an archive written by export
+#
+def import_archive(archive_path):
+      import tarfile
+      try:
+            print("[INFO] Importing archive...")
+            entries = []
+            # The store location of every imported image, by archive name
+            imported = {}
+            with tarfile.open(archive_path, "r|*") as archive:
+                  for member in archive:
+                        if (member.name == "manifest.jsonl"):
+                              # Read the entries
+                              entries = [json.loads(line) for line in archive.extractfile(member)]
+                        elif (member.isfile() and member.name.startswith("images/")):
+                              # Stream the image into the store, one chunk at a time
+                              image_file = archive.extractfile(member)
+                              checksum, extension = os.path.splitext(os.path.basename(member.name))
+                              new_image_path = store_chunks(iter(lambda: image_file.read(CHUNK_SIZE), b""), extension)
+                              # The store names the image after its checksum, which must match the archive
+                              if (new_image_path.stem != checksum):
+                                    print(f"[ERROR] Checksum mismatch for {member.name}, skipping it.")
+                                    # Leave nothing behind in the store, unless an entry already uses the same image
+                                    if (not fetch_one("SELECT 1 FROM entries WHERE image_location=?", (str(new_image_path),))):
+                                          os.remove(new_image_path)
+                                    continue
+                              imported[member.name] = (str(new_image_path), prepare_image(new_image_path))
+            # Point the entries at the local store
+            rows = [(entry['date'], entry['title'], entry['explanation'], entry['url'],
+                     *imported.get(entry['image'], (None, None)), entry['added'],
+                     entry.get('media_type', 'image'), entry.get('image_url')) for entry in entries]
+            # Insert every entry in one transaction, keeping the entries already stored
+            with transaction() as connection:
+                  result = connection.executemany("""INSERT INTO entries(date, title, explanation, url, image_location, phash, added, media_type, image_url)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT DO NOTHING""", rows)
+                  added = result.rowcount
+            print(f"[INFO] Imported {len(imported)} images and {added} of {len(rows)} entries.")
+      except Exception as e:
+            print(f"[ERROR] Unable to import archive: {e}")
+#
+# Re-encode or restore a single image (runs in a worker process)
+#
+def optimize_image(task):
+      image_location, url, image_format, quality = task
+      try:
+            old_size = os.path.getsize(image_location)
+            if (image_format == 'original'):
+                  # Download the original bytes into the store again
+                  image_response = nasa_get(url, stream=True)
+                  if (image_response.status_code != 200):
+                        image_response.close()
+                        raise Exception(f"Unable to fetch the original image. Status code: {image_response.status_code}")
+                  new_image_path = store_image(image_response)
+                  # An error page is no image, and the stored image is kept instead
+                  try:
+                        validate_image(new_image_path)
+                  except Exception:
+                        os.remove(new_image_path)
+                        raise
+            else:
+                  from PIL import Image
+                  # Re-encode the image in memory
+                  image = Image.open(image_location)
+                  if (image_format == 'jpeg' and image.mode != 'RGB'):
+                        image = image.convert('RGB')
+                  buffer = BytesIO()
+                  image.save(buffer, image_format.upper(), quality=quality, optimize=True)
+                  # Keep the image as it is if re-encoding does not make it smaller
+                  if (buffer.tell() >= old_size):
+                        return image_location, image_location, old_size, old_size, None
+                  # Save the re-encoded image in the store
+                  new_image_path = store_chunks([buffer.getvalue()], OPTIMIZE_FORMATS[image_format])
+            # Return the old and new location and size
+            return image_location, str(new_image_path), old_size, os.path.getsize(new_image_path), None
+      except Exception as e:
+            # A failed image is reported without stopping the others
+            return image_location, None, 0, 0, str(e)
+#
+# Point the entries at their optimized images and remove the old images nobody uses anymore
+#
+def commit_optimized(results, setting):
+      with transaction() as connection:
+            connection.executemany("UPDATE entries SET image_location=? WHERE image_location=?",
+                                 [(new_location, old_location) for old_location, new_location, *_ in results])
+            connection.executemany("INSERT OR REPLACE INTO optimize_progress(image_location, setting) VALUES (?, ?)",
+                                 [(new_location, setting) for _, new_location, *_ in results])
+      for old_location, new_location, *_ in results:
+            # Only images of the collection are ever removed
+            if (old_location == new_location or not os.path.abspath(old_location).startswith(os.path.abspath(APOD_DIRECTORY))):
+                  continue
+            if (not fetch_one("SELECT 1 FROM entries WHERE image_location=?", (old_location,))):
+                  os.remove(old_location)
+#
+# Re-encode every stored image, or restore its original bytes, using one process per core
+#
+def optimize(arguments=()):
+      try:
+            # Read the format and quality
+            image_format = arguments[0].lower() if len(arguments) > 0 else OPTIMIZE_FORMAT
+            quality = int(arguments[1]) if len(arguments) > 1 else OPTIMIZE_QUALITY
+            if (image_format not in OPTIMIZE_FORMATS and image_format != 'original'):
+                  raise ValueError(f"Unknown format '{image_format}'")
+            setting = image_format if image_format == 'original' else f"{image_format}:{quality}"
+            # Every image once, skipping those already optimized with the same setting
+            tasks = [(image_location, url, image_format, quality) for image_location, url in fetch_all(
+                  """SELECT image_location, MIN(COALESCE(image_url, url)) FROM entries
+                        WHERE image_location IS NOT NULL AND image_location NOT IN
+                              (SELECT image_location FROM optimize_progress WHERE setting=?)
+                        GROUP BY image_location""", (setting,))]
+            tasks = [task for task in tasks if os.path.exists(task[0]) and (task[1] or image_format != 'original')]
+            print(f"[INFO] Optimizing {len(tasks)} images to {setting} with {os.cpu_count()} processes...")
+            started = time.monotonic()
+            bytes_before = bytes_after = 0
+            pending = []
+            failed = 0
+            # Spawn fresh workers, forking would copy the locks held by the background threads
+            import multiprocessing
+            with multiprocessing.get_context("spawn").Pool(processes=os.cpu_count()) as pool:
+                  for result in pool.imap_unordered(optimize_image, tasks, chunksize=4):
+                        # Failed images are left as they are, and tried again by the next run
+                        if (result[4] is not None):
+                              print(f"[WARNING] Unable to optimize {result[0]}: {result[4]}")
+                              failed += 1
+                              continue
+                        bytes_before += result[2]
+                        bytes_after += result[3]
+                        pending.append(result)
+                        # Commit in batches so an interrupted run keeps its progress
+                        if (len(pending) >= OPTIMIZE_BATCH):
+                              commit_optimized(pending, setting)
+                              pending = []
+            commit_optimized(pending, setting)
+            # Report the savings and the throughput
+            elapsed = max(time.monotonic() - started, 1e-9)
+            print(f"[INFO] Optimized {len(tasks) - failed} images in {elapsed:.1f} seconds ({len(tasks) / elapsed:.1f} images/s, {bytes_before / elapsed / 1024 / 1024:.1f} MB/s).")
+            if (failed):
+                  print(f"[WARNING] {failed} images could not be optimized.")
+            print(f"[INFO] Saved {(bytes_before - bytes_after) / 1024 / 1024:.1f} MB ({bytes_before} -> {bytes_after} bytes).")
+      except Exception as e:
+            print(f"[ERROR] Unable to optimize images: {e}")
+#
+# Compute the 64-bit difference hash of an image
+#
+@measure('image_hash')
+def image_hash(image_location):
+      import numpy
+      from PIL import Image
+      image = Image.open(image_location)
+      # Let the JPEG decoder downscale while decoding, the hash only needs a few pixels
+      image.draft('L', (64, 64))
+      # Shrink to 9x8 grey pixels
+      pixels = numpy.asarray(image.convert('L').resize((9, 8), Image.LANCZOS), dtype=numpy.int16)
+      # Each bit tells if a pixel is brighter than its left neighbour
+      bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+      value = int.from_bytes(numpy.packbits(bits).tobytes(), 'big')
+      # SQLite integers are signed
+      return value - (1 << 64) if value >= (1 << 63) else value
+#
+# Count the bits two hashes differ in
+#
+def hash_distance(first_hash, second_hash):
+      return ((first_hash ^ second_hash) & 0xFFFFFFFFFFFFFFFF).bit_count()
+#
+# Add a hash to a BK-tree, where each node is [hash, entry IDs, children by distance]
+#
+def bk_insert(tree, phash, id):
+      if (tree is None):
+            return [phash, [id], {}]
+      node = tree
+      while (True):
+            distance = hash_distance(node[0], phash)
+            # Identical hashes share a node
+            if (distance == 0):
+                  node[1].append(id)
+                  return tree
+            child = node[2].get(distance)
+            if (child is None):
+                  node[2][distance] = [phash, [id], {}]
+                  return tree
+            node = child
+#
+# Find every entry of a BK-tree within a distance of a hash
+#
+def bk_search(tree, phash, radius):
+      results = []
+      nodes = [tree] if tree else []
+      while (nodes):
+            node = nodes.pop()
+            distance = hash_distance(node[0], phash)
+            if (distance <= radius):
+                  results.extend((distance, id) for id in node[1])
+            # By the triangle inequality only these children can hold matches
+            for child_distance, child in node[2].items():
+                  if (distance - radius <= child_distance <= distance + radius):
+                        nodes.append(child)
+      return results
+#
+# Get the BK-tree of the stored hashes, rebuilding it when the entries changed
+#
+def similarity_tree():
+      with similarity_lock:
+            # Stored hashes only change or go away along with the version, new entries get higher IDs
+            version = fetch_one("SELECT version FROM phash_version")[0]
+            indexed = similarity_index['signature']
+            if (indexed is None or indexed[0] != version):
+                  similarity_index.update(tree=None, ids=array('q'), hashes=array('q'))
+                  indexed = (version, 0)
+            # Add the entries stored since the tree was built
+            added = fetch_all("SELECT id, phash FROM entries WHERE id > ? AND phash IS NOT NULL", (indexed[1],))
+            for id, phash in added:
+                  similarity_index['tree'] = bk_insert(similarity_index['tree'], phash, id)
+                  similarity_index['ids'].append(id)
+                  similarity_index['hashes'].append(phash)
+            similarity_index['signature'] = (version, max([indexed[1]] + [id for id, _ in added]))
+            return similarity_index['tree']
+#
+# Find the stored images closest to a hash (far apart hashes make a BK-tree walk most of its nodes, so every hash is compared at once)
+#
+def nearest_images(phash, count, excluded=()):
+      import numpy
+      similarity_tree()
+      with similarity_lock:
+            ids = numpy.array(similarity_index['ids'], dtype=numpy.int64)
+            hashes = numpy.array(similarity_index['hashes'], dtype=numpy.int64).view(numpy.uint64)
+      # Count the differing bits of every hash, unsigned so the sign bit counts as any other
+      differences = numpy.bitwise_xor(hashes, numpy.uint64(phash & 0xFFFFFFFFFFFFFFFF))
+      if (hasattr(numpy, 'bitwise_count')):
+            distances = numpy.bitwise_count(differences).astype(numpy.int64)
+      else:
+            # Before NumPy 2.0 the bits are unpacked and summed
+            distances = numpy.unpackbits(differences.view(numpy.uint8)).reshape(-1, 64).sum(axis=1, dtype=numpy.int64)
+      keep = ~numpy.isin(ids, numpy.fromiter(excluded, dtype=numpy.int64))
+      ids, distances = ids[keep], distances[keep]
+      # Only the closest are sorted, by distance and then by ID
+      closest = numpy.argpartition(distances * (1 << 40) + ids, count)[:count] if (len(ids) > count) else numpy.arange(len(ids))
+      return sorted((int(distances[position]), int(ids[position])) for position in closest)
+#
+# Warn about stored images that look like new ones
+#
+def flag_near_duplicates(new_entries):
+      # The tree is brought up to date once for the whole batch
+      tree = similarity_tree() if any(phash is not None for _, phash in new_entries) else None
+      for date, phash in new_entries:
+            if (phash is None):
+                  continue
+            for distance, id in sorted(bk_search(tree, phash, NEAR_DUPLICATE_DISTANCE)):
+                  entry = fetch_one("SELECT date, title FROM entries WHERE id=?", (id,))
+                  if (entry and entry[0] != date):
+                        print(f"[WARNING] The image of {date} looks like entry {id} ({entry[0]}, {entry[1]}), {distance} bits apart.")
+#
+# Hash the stored images that have no hash yet
+#
+def hash_missing_images():
+      missing = fetch_all("SELECT id, image_location FROM entries INDEXED BY entries_unhashed WHERE phash IS NULL AND image_location IS NOT NULL")
+      hashes = []
+      for id, image_location in missing:
+            if (os.path.exists(image_location)):
+                  try:
+                        hashes.append((image_hash(image_location), id))
+                  except Exception as e:
+                        print(f"[WARNING] Unable to hash entry {id}: {e}")
+      if (hashes):
+            print(f"[INFO] Hashed {len(hashes)} images.")
+            with transaction() as connection:
+                  connection.executemany("UPDATE entries SET phash=? WHERE id=?", hashes)
+#
+# List the stored images that look most like an entry
+#
+def similar(arguments):
+      try:
+            if (not arguments):
+                  raise ValueError("No entry ID given")
+            # Hash the images stored before hashing existed
+            hash_missing_images()
+            entry = fetch_one("SELECT id, phash FROM entries WHERE id=?", (arguments[0],))
+            if (entry is None or entry[1] is None):
+                  raise ValueError(f"No image for entry {arguments[0]}")
+            matches = nearest_images(entry[1], SIMILAR_RESULTS, {entry[0]})
+            print("\nSimilar entries: ")
+            for distance, id in matches:
+                  date, title = fetch_one("SELECT date, title FROM entries WHERE id=?", (id,))
+                  print(f"    {id}      {date}      {title}      ({distance} bits apart)")
+      except Exception as e:
+            print(f"[ERROR] Unable to find similar entries: {e}")
+#
 # Show the main menu
 #
 def main_interface():
@@ -355,86 +1900,711 @@ def help_interface():
       # Help interface
       print("""-      List of available commands      -\n
       UPDATE       # Update the database.
+      BACKFILL     # Fill the database with the APODs between two dates.
       VIEW         # View an entry based on it's ID.
       SEARCH       # Search for an entry to the database.
+      SIMILAR      # List the images that look like an entry, e.g. 'SIMILAR 12'.
       SORT         # Sort the entries.
-      LIST         # List all enties.
+      LIST         # List all enties. Options: date|title|id, asc|desc, --json, --page-size N.
       APOD         # Display the current Astronomy Picture of the Day.
       HELP         # List all available commands.
+      STATS        # Show where the time goes. Options: export FILE, prometheus FILE, reset.
+      PROFILE      # Profile a single command, e.g. 'PROFILE LIST --json'.
+      SERVE        # Serve the archive over HTTP. Options: [host] port.
       PING         # Ping the NASA server.
+      CACHE        # Show how the HTTP cache is doing.
       API          # Modify the API key.
+      OPTIMIZE     # Re-encode the stored images. Options: jpeg|webp|png|original, quality.
+      EXPORT       # Export the archive to a single file.
+      IMPORT       # Import an archive exported before.
       CLEAR        # Clear the terminal.
       EXIT         # Exit the program.""")
 #
-# Auto update the database as a background process
+# Fetch the entries newer than the latest stored one
+#
+def incremental_update(stop_event=None):
+      # Find the latest stored APOD date
+      latest = fetch_one("SELECT MAX(date) FROM entries")[0]
+      # The latest date NASA may serve, which may still be yesterday here
+      apod_today = (datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=APOD_UTC_OFFSET)).date()
+      # Start from the day after, or from NASA's today on an empty database
+      if (latest):
+            start_date = datetime.date.fromisoformat(latest) + datetime.timedelta(days=1)
+      else:
+            start_date = apod_today
+      # Nothing to fetch if the database is up to date, asking for a later date only gets an error
+      if (start_date > apod_today):
+            return
+      # Fetch the missing dates
+      backfill(start_date.isoformat(), stop_event=stop_event)
+#
+# Auto update the database in a background thread
+#
+def auto_update(stop_event):
+      # The pool gives the thread its own connection whenever it touches the database
+      while (not stop_event.is_set()):
+            try:
+                  # Perform a database update
+                  incremental_update(stop_event)
+            except Exception as e:
+                  print(f"[ERROR] Unable to auto update database: {e}")
+            # Wait for the next poll, with jitter, unless asked to stop
+            stop_event.wait(AUTO_UPDATE_INTERVAL + random.uniform(-AUTO_UPDATE_JITTER, AUTO_UPDATE_JITTER))
+#
+# Database migrations, applied in order (the schema version is kept in PRAGMA user_version)
 #
-def auto_update():
-      # Inform user about the pending update
-      print("[INFO] Updating database...")
-      # Perform a database update
-      update()
-      # Inform user about the update completition
-      print("[INFO] Update complete.")
-      # The time sequence between updates
-      time.sleep(3600)
+MIGRATIONS = [
+      # 1: The original entries table
+      ["CREATE TABLE IF NOT EXISTS entries(id, title, explanation, image_location, date)"],
+      # 2: Autoincrement IDs, ISO dates, and unique APOD dates and media urls
+      ["DROP TABLE IF EXISTS entries_search",
+       """CREATE TABLE entries_new(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT NOT NULL,
+            explanation TEXT,
+            image_location TEXT,
+            date TEXT NOT NULL,
+            url TEXT,
+            added TEXT NOT NULL)""",
+       "CREATE UNIQUE INDEX entries_date ON entries_new(date)",
+       "CREATE UNIQUE INDEX entries_url ON entries_new(url)",
+       # Old entries were dated 'dd/mm/YYYY - HH:MM:SS' when added, which was the day of their APOD,
+       # and a day added twice keeps its first entry
+       """INSERT OR IGNORE INTO entries_new(id, title, explanation, image_location, date, added)
+            SELECT id, title, explanation, image_location,
+                  CASE WHEN date GLOB '[0-9][0-9]/[0-9][0-9]/[0-9][0-9][0-9][0-9]*'
+                        THEN substr(date, 7, 4) || '-' || substr(date, 4, 2) || '-' || substr(date, 1, 2) ELSE date END,
+                  CASE WHEN date GLOB '[0-9][0-9]/[0-9][0-9]/[0-9][0-9][0-9][0-9] - *'
+                        THEN substr(date, 7, 4) || '-' || substr(date, 4, 2) || '-' || substr(date, 1, 2) || 'T' || substr(date, 14) ELSE date END
+            FROM entries WHERE title IS NOT NULL AND date IS NOT NULL ORDER BY id""",
+       "DROP TABLE entries",
+       "ALTER TABLE entries_new RENAME TO entries"],
+      # 3: Full-text search index over titles and explanations, kept in sync by triggers
+      ["""CREATE VIRTUAL TABLE entries_search USING fts5(
+            title, explanation, content='entries', content_rowid='id', tokenize='porter unicode61')""",
+       """CREATE TRIGGER entries_search_insert AFTER INSERT ON entries BEGIN
+            INSERT INTO entries_search(rowid, title, explanation) VALUES (new.id, new.title, new.explanation);
+       END""",
+       """CREATE TRIGGER entries_search_delete AFTER DELETE ON entries BEGIN
+            INSERT INTO entries_search(entries_search, rowid, title, explanation) VALUES ('delete', old.id, old.title, old.explanation);
+       END""",
+       """CREATE TRIGGER entries_search_update AFTER UPDATE ON entries BEGIN
+            INSERT INTO entries_search(entries_search, rowid, title, explanation) VALUES ('delete', old.id, old.title, old.explanation);
+            INSERT INTO entries_search(rowid, title, explanation) VALUES (new.id, new.title, new.explanation);
+       END""",
+       "INSERT INTO entries_search(entries_search) VALUES ('rebuild')"],
+      # 4: Progress of the backfilled dates
+      ["CREATE TABLE IF NOT EXISTS backfill_progress(date TEXT PRIMARY KEY, status TEXT)"],
+      # 5: Listing by title
+      ["CREATE INDEX entries_title ON entries(title)"],
+      # 6: The setting each image was last optimized with
+      ["CREATE TABLE optimize_progress(image_location TEXT PRIMARY KEY, setting TEXT NOT NULL)"],
+      # 7: The perceptual hash of each image
+      ["ALTER TABLE entries ADD COLUMN phash INTEGER"],
+      # 8: The media type of each entry, and where its stored image came from
+      ["ALTER TABLE entries ADD COLUMN media_type TEXT NOT NULL DEFAULT 'image'",
+       "ALTER TABLE entries ADD COLUMN image_url TEXT"],
+      # 9: Load the catalog without reading the explanations, know when it is stale, and find entries by image
+      ["CREATE INDEX entries_catalog ON entries(date, title)",
+       "CREATE INDEX entries_image ON entries(image_location)",
+       "CREATE TABLE entries_version(version INTEGER NOT NULL)",
+       "INSERT INTO entries_version VALUES (0)",
+       "CREATE TRIGGER entries_version_insert AFTER INSERT ON entries BEGIN UPDATE entries_version SET version = version + 1; END",
+       "CREATE TRIGGER entries_version_delete AFTER DELETE ON entries BEGIN UPDATE entries_version SET version = version + 1; END",
+       "CREATE TRIGGER entries_version_update AFTER UPDATE OF date, title ON entries BEGIN UPDATE entries_version SET version = version + 1; END"],
+      # 10: Find the images without a hash, and know when stored hashes change so new ones can be indexed on their own
+      ["CREATE INDEX entries_unhashed ON entries(id) WHERE phash IS NULL AND image_location IS NOT NULL",
+       "CREATE TABLE phash_version(version INTEGER NOT NULL)",
+       "INSERT INTO phash_version VALUES (0)",
+       "CREATE TRIGGER phash_version_delete AFTER DELETE ON entries WHEN old.phash IS NOT NULL BEGIN UPDATE phash_version SET version = version + 1; END",
+       "CREATE TRIGGER phash_version_update AFTER UPDATE OF phash ON entries WHEN old.phash IS NOT new.phash BEGIN UPDATE phash_version SET version = version + 1; END"],
+      # 11: Tell the database apart from others, for the catalog saved next to it
+      ["ALTER TABLE entries_version ADD COLUMN identity INTEGER NOT NULL DEFAULT 0",
+       "UPDATE entries_version SET identity = random()"],
+      # 12: Titles are listed from the catalog, so the index by title is only kept up to date
+      ["DROP INDEX IF EXISTS entries_title"],
+]
+#
+# Bring the database schema up to date
+#
+def migrate(connection):
+      # Find the version of the database
+      version = connection.execute("PRAGMA user_version").fetchone()[0]
+      # Apply every missing migration in its own transaction
+      for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            print(f"[INFO] Applying database migration {number}...")
+            try:
+                  connection.execute("BEGIN")
+                  for statement in statements:
+                        connection.execute(statement)
+                  # Record the new version along with the changes
+                  connection.execute(f"PRAGMA user_version = {number}")
+                  connection.commit()
+            except Exception:
+                  # Leave the database at the last complete version
+                  connection.rollback()
+                  raise
+#
+# Open a tuned connection to the database
+#
+def open_connection():
+      # Pooled connections move between threads, and transactions are begun explicitly
+      connection = sqlite3.connect(database_path, check_same_thread=False, timeout=DATABASE_TIMEOUT,
+                                   isolation_level=None, cached_statements=DATABASE_CACHED_STATEMENTS)
+      # Readers never wait for the writer with write-ahead logging
+      connection.execute("PRAGMA journal_mode=WAL")
+      # With WAL, syncing at checkpoints is enough to stay consistent
+      connection.execute("PRAGMA synchronous=NORMAL")
+      connection.execute(f"PRAGMA cache_size=-{DATABASE_CACHE_KB}")
+      return connection
+#
+# Borrow a connection from the pool
+#
+@contextlib.contextmanager
+def database_connection():
+      try:
+            # Reuse an idle connection
+            connection = database_pool.get_nowait()
+      except queue.Empty:
+            with database_pool_lock:
+                  # Open a new one while the pool has room
+                  opened = database_pool_state['open'] < DATABASE_POOL_SIZE
+                  if (opened):
+                        database_pool_state['open'] += 1
+            # Otherwise wait for one to be returned
+            connection = open_connection() if opened else database_pool.get(timeout=DATABASE_TIMEOUT)
+      try:
+            yield connection
+      finally:
+            # Never hand an unfinished transaction to the next borrower
+            if (connection.in_transaction):
+                  connection.rollback()
+            database_pool.put(connection)
+#
+# Run statements in one transaction, committed when the block ends and rolled back on errors
+#
+@contextlib.contextmanager
+def transaction():
+      with database_connection() as connection, measure('sql_transaction'):
+            # Take the write lock up front so the transaction cannot fail halfway on a busy database
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                  yield connection
+                  connection.commit()
+            except Exception:
+                  connection.rollback()
+                  raise
+#
+# Fetch every row of a query
+#
+def fetch_all(query, parameters=()):
+      with database_connection() as connection, measure('sql_query'):
+            return connection.execute(query, parameters).fetchall()
+#
+# Fetch the first row of a query
+#
+def fetch_one(query, parameters=()):
+      with database_connection() as connection, measure('sql_query'):
+            return connection.execute(query, parameters).fetchone()
 #
 # Establish connection with database
 #
 def connect(database_file):
-      # Open the connection and return it to main
-      #try:
-            # Store the connection to a variable
-            connection = sqlite3.connect(f"{database_file}.db")
-            # Inform user about the successful connection
-            print("[INFO] Connection with database established.")
-            # Return connection to main
-            return connection
-      #except Exception as e:
-            #print(f"[ERROR] Unable to establish connection with database: {e}")
-            #return None
-#
-# Create a database cursor
-#
-""" def get_cursor(database):
-      # Try to create a new cursor
-      try:
-            # Create the cursor
-            cursor = database.cursor()
-            # Inform the user about the successful creation of database cursor
-            print("[INFO] Created cursor successfully.")
-            # Return cursor to main
-            return cursor
+      global database_path
+      # Every pooled connection opens this file
+      database_path = f"{database_file}.db"
+      # Create or upgrade the database schema
+      with database_connection() as connection:
+            migrate(connection)
+      # Inform user about the successful connection
+      print("[INFO] Connection with database established.")
+#
+# Terminate the database connections
+#
+def close_database():
+      # Close every idle connection of the pool
+      while (True):
+            try:
+                  database_pool.get_nowait().close()
+            except queue.Empty:
+                  break
+      database_pool_state['open'] = 0
+#
+# Run a blocking function on the worker threads of the server
+#
+async def run_blocking(function, *arguments):
+      import asyncio
+      return await asyncio.get_running_loop().run_in_executor(None, function, *arguments)
+#
+# Write the status line and the headers of a response
+#
+def send_head(request, writer, status, headers):
+      from http import HTTPStatus
+      # A connection the client or the server wants gone is closed after the response
+      if (not request['keep_alive']):
+            headers['Connection'] = "close"
+      lines = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}", f"Server: {SERVER_NAME}", *(f"{name}: {value}" for name, value in headers.items())]
+      writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1'))
+      # Nothing else may be answered to the request from now on
+      request['responded'] = True
+      count_metric(f"server_responses_{status}")
+#
+# Send a whole response
+#
+def send_response(request, writer, status, body=b"", content_type="application/json", headers=None):
+      headers = {'Content-Type': content_type, 'Content-Length': len(body), **(headers or {})}
+      send_head(request, writer, status, headers)
+      # Answers to HEAD requests have the headers of a GET but no body
+      if (request['method'] != 'HEAD'):
+            writer.write(body)
+#
+# Send a JSON document
+#
+def send_json(request, writer, data, status=200, headers=None):
+      send_response(request, writer, status, json.dumps(data).encode(), headers=headers)
+#
+# Send an error as a JSON document
+#
+def send_error(request, writer, status, message, headers=None):
+      send_json(request, writer, {'error': message}, status, headers)
+#
+# Read a positive integer from the query string
+#
+def query_number(parameters, name, default, maximum=None):
+      value = int(parameters.get(name, default))
+      if (value < 1):
+            raise ValueError(f"'{name}' must be a positive number")
+      return min(value, maximum) if maximum else value
+#
+# Find the single byte range a Range header asks for
+#
+def byte_range(header, size):
+      # Only single ranges of bytes are served, anything else gets the whole file
+      match = re.fullmatch(r"bytes=(\d*)-(\d*)", header.strip())
+      if (not match or match.group(1) == match.group(2) == ""):
+            return None
+      first, last = match.groups()
+      # A range that ends before it starts is not a valid one, so it is ignored
+      if (first and last and int(last) < int(first)):
+            return None
+      if (first == ""):
+            # A suffix range asks for the last bytes of the file
+            first, last = max(size - int(last), 0), size - 1 if int(last) else -1
+      else:
+            first, last = int(first), min(int(last), size - 1) if last else size - 1
+      # Empty ranges and ranges starting past the end can not be satisfied
+      if (first >= size or first > last):
+            raise ValueError(header)
+      return first, last
+#
+# Serve a page of the catalog
+#
+async def serve_entries(request, writer):
+      parameters = request['parameters']
+      sort_key = parameters.get('sort', 'date')
+      order = parameters.get('order', 'asc')
+      if (sort_key not in SORT_COLUMNS or order not in ('asc', 'desc')):
+            return send_error(request, writer, 400, f"'sort' must be one of {', '.join(SORT_COLUMNS)} and 'order' one of asc, desc")
+      page = query_number(parameters, 'page', 1)
+      page_size = query_number(parameters, 'page_size', LIST_PAGE_SIZE, SERVER_PAGE_LIMIT)
+      # Read one extra row to know if there is another page
+      rows = await run_blocking(catalog_page, sort_key, order == 'desc', (page - 1) * page_size, page_size + 1)
+      send_json(request, writer, {'entries': [{'id': id, 'date': date, 'title': title} for date, title, id in rows[:page_size]],
+                                  'next_page': page + 1 if len(rows) > page_size else None})
+#
+# Serve a page of search results
+#
+async def serve_search(request, writer):
+      query = search_query(request['parameters'].get('q', ""))
+      if (not query):
+            return send_error(request, writer, 400, "Nothing to search for, 'q' is missing")
+      page = query_number(request['parameters'], 'page', 1)
+      rows = await run_blocking(search_entries, query, page)
+      send_json(request, writer, {'entries': [{'id': id, 'date': date, 'title': title, 'snippet': snippet}
+                                              for id, title, date, image_location, snippet in rows[:SEARCH_PAGE_SIZE]],
+                                  'next_page': page + 1 if len(rows) > SEARCH_PAGE_SIZE else None})
+#
+# Serve the metadata of an entry
+#
+async def serve_entry(request, writer, id):
+      row = await run_blocking(fetch_one, "SELECT id, date, title, explanation, media_type, url, image_url, image_location FROM entries WHERE id=?", (id,))
+      if (not row):
+            return send_error(request, writer, 404, f"No entry with ID {id}")
+      id, date, title, explanation, media_type, url, image_url, image_location = row
+      send_json(request, writer, {'id': id, 'date': date, 'title': title, 'explanation': explanation, 'media_type': media_type,
+                                  'url': url, 'image_url': image_url, 'image': f"/entries/{id}/image" if image_location else None})
+#
+# Serve the stored image of an entry, straight from the file to the socket
+#
+async def serve_image(request, writer, id):
+      row = await run_blocking(fetch_one, "SELECT image_location FROM entries WHERE id=?", (id,))
+      if (not row or not row[0]):
+            return send_error(request, writer, 404, f"No image for entry {id}")
+      image_location = row[0]
+      # The stored images are named after the hash of their content, so it never changes
+      headers = {'ETag': f'"{Path(image_location).stem}"', 'Cache-Control': f"public, max-age={ARCHIVE_CACHE_TTL}, immutable", 'Accept-Ranges': "bytes"}
+      if (request['headers'].get('if-none-match') in (headers['ETag'], "*")):
+            return send_head(request, writer, 304, headers)
+      try:
+            file = open(image_location, 'rb')
+      except OSError:
+            return send_error(request, writer, 404, f"The image of entry {id} is missing")
+      with file:
+            size = os.fstat(file.fileno()).st_size
+            try:
+                  # A Range is ignored when the client's copy is not the current one
+                  if_range = request['headers'].get('if-range', headers['ETag'])
+                  span = byte_range(request['headers']['range'], size) if ('range' in request['headers'] and if_range == headers['ETag']) else None
+            except ValueError:
+                  return send_error(request, writer, 416, f"The image of entry {id} has {size} bytes, none of them in the range asked for",
+                                    {'Content-Range': f"bytes */{size}"})
+            status, first, last = (206, *span) if span else (200, 0, size - 1)
+            if (span):
+                  headers['Content-Range'] = f"bytes {first}-{last}/{size}"
+            content_type = mimetypes.guess_type(image_location)[0] or "application/octet-stream"
+            send_head(request, writer, status, {'Content-Type': content_type, 'Content-Length': last - first + 1, **headers})
+            if (request['method'] == 'HEAD' or size == 0):
+                  return
+            # Flush the headers, then let the kernel copy the file when it can
+            await writer.drain()
+            import asyncio
+            await asyncio.get_running_loop().sendfile(writer.transport, file, first, last - first + 1)
+            count_metric('server_image_bytes', last - first + 1)
+#
+# Serve the APOD of a day or a window of days from NASA
+#
+async def serve_apod(request, writer, server):
+      import asyncio
+      parameters = request['parameters']
+      start_date = parameters.get('start_date') or parameters.get('date')
+      end_date = parameters.get('end_date') or parameters.get('date')
+      for date in (start_date, end_date):
+            if (date and not re.fullmatch(r"\d{4}-\d{2}-\d{2}", date)):
+                  return send_error(request, writer, 400, f"'{date}' is not a date (YYYY-MM-DD)")
+      if (not server['api_keys']):
+            return send_error(request, writer, 503, "No API key to ask NASA with")
+      # Clients asking for the same dates at the same time share a single upstream request
+      key = (start_date, end_date)
+      fetch = server['inflight'].get(key)
+      if (fetch is None):
+            fetch = asyncio.ensure_future(run_blocking(lambda: get_apod(pick_api_key(server['api_keys']), start_date, end_date)))
+            server['inflight'][key] = fetch
+            fetch.add_done_callback(lambda done: server['inflight'].pop(key, None))
+      else:
+            count_metric('server_coalesced')
+      # A client hanging up does not cancel the request of the others
+      apod_data = await asyncio.shield(fetch)
+      if (apod_data is None):
+            return send_error(request, writer, 502, "Unable to fetch APOD data from NASA")
+      # A single date is asked for as a window of one day, but answered with its APOD alone
+      if ('date' in parameters and not isinstance(apod_data, dict)):
+            if (not apod_data):
+                  return send_error(request, writer, 404, f"No APOD for {parameters['date']}")
+            apod_data = apod_data[0]
+      send_json(request, writer, apod_data)
+#
+# Route a request to its handler
+#
+async def serve_request(request, writer, server):
+      if (request['method'] not in ('GET', 'HEAD')):
+            return send_response(request, writer, 405, headers={'Allow': "GET, HEAD"})
+      parts = request['path'].strip('/').split('/')
+      try:
+            if (parts == ['entries']):
+                  await serve_entries(request, writer)
+            elif (parts == ['search']):
+                  await serve_search(request, writer)
+            elif (parts == ['apod']):
+                  await serve_apod(request, writer, server)
+            elif (len(parts) == 2 and parts[0] == 'entries' and parts[1].isdigit()):
+                  await serve_entry(request, writer, int(parts[1]))
+            elif (len(parts) == 3 and parts[0] == 'entries' and parts[1].isdigit() and parts[2] == 'image'):
+                  await serve_image(request, writer, int(parts[1]))
+            else:
+                  send_error(request, writer, 404, f"Nothing at {request['path']}")
+      except ValueError as e:
+            # An error after the head of the response was sent can only close the connection
+            if (request.get('responded')):
+                  raise
+            send_error(request, writer, 400, str(e))
+#
+# Read the requests of a connection, one after the other, until it is closed or stays idle
+#
+async def serve_connection(reader, writer, server=None):
+      import asyncio
+      from urllib.parse import parse_qsl, urlsplit
+      server = server or {'api_keys': [], 'inflight': {}, 'connections': set()}
+      count_metric('server_connections')
+      # Remember the connection, so it can be closed when the server stops
+      server['connections'].add(asyncio.current_task())
+      try:
+            while (True):
+                  try:
+                        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), SERVER_IDLE_TIMEOUT)
+                  except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+                        break
+                  with measure('server_request'):
+                        request_line, *header_lines = head.decode('latin-1').rstrip("\r\n").split("\r\n")
+                        try:
+                              method, target, version = request_line.split(" ")
+                              headers = {name.strip().lower(): value.strip() for name, value in (line.split(":", 1) for line in header_lines)}
+                              # A body is not expected, but is read so the next request starts where it should
+                              if (int(headers.get('content-length', 0))):
+                                    await reader.readexactly(int(headers['content-length']))
+                        except ValueError:
+                              send_response({'method': 'GET', 'keep_alive': False}, writer, 400)
+                              break
+                        url = urlsplit(target)
+                        connection = headers.get('connection', "").lower()
+                        request = {'method': method, 'path': url.path, 'parameters': dict(parse_qsl(url.query)), 'headers': headers,
+                                   'keep_alive': connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"}
+                        try:
+                              await serve_request(request, writer, server)
+                        except (ConnectionError, asyncio.CancelledError):
+                              raise
+                        except Exception as e:
+                              print(f"[ERROR] Unable to serve {method} {target}: {e}")
+                              request['keep_alive'] = False
+                              if (request.get('responded')):
+                                    break
+                              send_error(request, writer, 500, "Internal error")
+                        await writer.drain()
+                  if (not request['keep_alive']):
+                        break
+      except (ConnectionError, asyncio.CancelledError):
+            pass
+      finally:
+            server['connections'].discard(asyncio.current_task())
+            writer.close()
+#
+# Start the HTTP server and run it until it is stopped
+#
+async def run_server(host, port, started=None):
+      import asyncio
+      # The database work runs on a few threads next to the event loop
+      asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(SERVER_WORKERS, thread_name_prefix="server"))
+      try:
+            api_keys = read_api_keys()
       except Exception as e:
-            print(f"[ERROR] Unable to create database cursor: {e}")
-            return None """
+            print(f"[WARNING] /apod is disabled: {e}")
+            api_keys = []
+      server_state = {'api_keys': api_keys, 'inflight': {}, 'connections': set()}
+      server = await asyncio.start_server(lambda reader, writer: serve_connection(reader, writer, server_state), host, port,
+                                          backlog=SERVER_BACKLOG, limit=SERVER_HEADER_LIMIT)
+      # Warm the catalog up before the first client asks for it
+      await run_blocking(entries_catalog)
+      address = server.sockets[0].getsockname()
+      print(f"[INFO] Serving the archive on http://{address[0]}:{address[1]}/ (Ctrl+C to stop).")
+      if (started):
+            started(address)
+      try:
+            async with server:
+                  await server.serve_forever()
+      finally:
+            # Close the connections still open, idle ones included
+            connections = [*server_state['connections']]
+            for connection in connections:
+                  connection.cancel()
+            await asyncio.gather(*connections, return_exceptions=True)
 #
-# Terminate the database connection
+# Serve the archive over HTTP
 #
-""" def terminate_connection(connection, cursor):
-      # Terminate the connection with the database
-      cursor.close()
-      connection.close() """
+def serve(host=SERVER_HOST, port=SERVER_PORT):
+      import asyncio
+      try:
+            asyncio.run(run_server(host, port))
+      except KeyboardInterrupt:
+            print("[INFO] Server stopped.")
+      except OSError as e:
+            print(f"[ERROR] Unable to start the server: {e}")
+#
+# Run a command of the main menu
+#
+def run_command(command, arguments):
+      if (command == "help"):
+            # Print the help interface
+            help_interface()
+      elif (command == "update"):
+            # Refresh database
+            update()
+      elif (command == "backfill"):
+            # Ask user for the window of dates (YYYY-MM-DD)
+            print("[INFO] Enter start and end date (YYYY-MM-DD). Leave end date empty for today.")
+            start_date = str(input(": "))
+            end_date = str(input(": ")) or None
+            # Fill the database
+            backfill(start_date, end_date)
+      elif (command == "list"):
+            # Show all entries
+            list(arguments)
+      elif (command == "sort"):
+            # Show all entries in the requested order
+            sort()
+      elif (command == "search"):
+            # Prompt a user input event
+            search_request = str(input(": "))
+            # Send request to search() function, one page at a time
+            page = 1
+            while (search(search_request, page)):
+                  # Ask user if more results should be shown
+                  if (str(input("[INFO] Press ENTER for more results or type anything to stop: ")) != ""):
+                        break
+                  page += 1
+      elif (command == "similar"):
+            # List the images that look like the requested one
+            similar(arguments)
+      elif (command == "apod"):
+            # Print the image of day
+            apod()
+      elif (command == "delete"):
+            # Ask user which entry to remove by ID
+            delete_request = str(input(": "))
+            delete(delete_request)
+      elif (command == "view"):
+            # View a specific entry
+            view_request = str(input(": "))
+            view(view_request)
+      elif (command == "ping"):
+            # Ping the servers
+            ping()
+      elif (command == "stats"):
+            # Show or export where the time goes
+            stats(arguments)
+      elif (command == "profile"):
+            # Run a command under the profiler
+            profile(arguments)
+      elif (command == "serve"):
+            # Serve the archive over HTTP, e.g. 'SERVE 8080' or 'SERVE 0.0.0.0 8080'
+            *host, port = arguments or [SERVER_PORT]
+            try:
+                  port = int(port)
+            except ValueError:
+                  print(f"[ERROR] '{port}' is not a port number.")
+            else:
+                  serve(host[0] if host else SERVER_HOST, port)
+      elif (command == "cache"):
+            # Show the HTTP cache counters
+            print(f"[INFO] HTTP cache hits: {cache_stats['hits']}, misses: {cache_stats['misses']}, revalidated: {cache_stats['revalidated']}")
+      elif (command == "api"):
+            # Change or modify API key
+            print("[INFO] Enter new API key.")
+            # Ask user for new API key
+            new_api = str(input(": ")).strip()
+            print("[INFO] Changing API key...")
+            # Try to verify the new API
+            response = ping(new_api)
+            # Check the response from the server
+            if (response == 200):
+                  try:
+                        write_api_key(new_api)
+                        print("[INFO] API key changed successfully.")
+                  except Exception as e:
+                        print(f"[ERROR] Unable to save API key: {e}")
+            else:
+                  print("[ERROR] Unable to change API key.")
+      elif (command == "optimize"):
+            # Re-encode the stored images
+            optimize(arguments)
+      elif (command == "export"):
+            # Ask user where to write the archive
+            export_archive(str(input(": ")))
+      elif (command == "import"):
+            # Ask user which archive to read
+            import_archive(str(input(": ")))
+      elif (command == "clear"):
+            # Clear the terminal
+            clear()
+      elif (command == ""):
+            # Just skip line
+            pass
+      else:
+            # Warn user for providing invalid input
+            print(f"[ERROR] Command '{' '.join([command, *arguments])}' not found.")
+#
+# Run a single command given on the command line, without the interactive menu
+#
+def command_line(arguments):
+      parser = argparse.ArgumentParser(prog="main.py", description="Handle NASA's Astronomy Picture of the Day. Without a command the interactive menu starts.")
+      parser.add_argument('--profile', action='store_true', help="profile the command")
+      parser.add_argument('--metrics', metavar='FILE', help="write the metrics of the command to FILE in the Prometheus text format")
+      commands = parser.add_subparsers(dest='command', required=True, metavar='command')
+      command = commands.add_parser('update', help="fetch the latest APOD")
+      command.add_argument('--since', metavar='DATE', help="fetch every APOD from DATE (YYYY-MM-DD) on instead")
+      command.set_defaults(run=lambda options: backfill(options.since) if options.since else update())
+      command = commands.add_parser('backfill', help="fetch every APOD between two dates")
+      command.add_argument('start_date', metavar='START', help="first date (YYYY-MM-DD)")
+      command.add_argument('end_date', metavar='END', nargs='?', help="last date, today if left out")
+      command.set_defaults(run=lambda options: backfill(options.start_date, options.end_date))
+      command = commands.add_parser('list', help="list the entries")
+      command.add_argument('sort_key', nargs='?', choices=SORT_COLUMNS, default='date')
+      command.add_argument('order', nargs='?', choices=('asc', 'desc'), default='asc')
+      command.add_argument('--json', action='store_true', help="one JSON object per line")
+      command.add_argument('--page-size', type=int, default=LIST_PAGE_SIZE)
+      command.set_defaults(run=lambda options: list([options.sort_key, options.order, '--page-size', str(options.page_size)] + ['--json'] * options.json, paged=False))
+      command = commands.add_parser('search', help="search the entries")
+      command.add_argument('words', nargs='+')
+      command.add_argument('--page', type=int, default=1)
+      command.set_defaults(run=lambda options: search(" ".join(options.words), options.page, show_image=False))
+      command = commands.add_parser('similar', help="list the images that look like an entry")
+      command.add_argument('id')
+      command.set_defaults(run=lambda options: similar([options.id]))
+      command = commands.add_parser('view', help="show an entry, until its window is closed")
+      command.add_argument('id')
+      command.set_defaults(run=lambda options: (view(options.id), wait_viewer()))
+      command = commands.add_parser('apod', help="show the current APOD, until its window is closed")
+      command.set_defaults(run=lambda options: (apod(), wait_viewer()))
+      command = commands.add_parser('delete', help="remove an entry")
+      command.add_argument('id')
+      command.set_defaults(run=lambda options: delete(options.id))
+      command = commands.add_parser('optimize', help="re-encode the stored images")
+      command.add_argument('options', nargs='*', metavar='jpeg|webp|png|original quality')
+      command.set_defaults(run=lambda options: optimize(options.options))
+      command = commands.add_parser('export', help="export the archive to a single file")
+      command.add_argument('path')
+      command.set_defaults(run=lambda options: export_archive(options.path))
+      command = commands.add_parser('import', help="import an archive exported before")
+      command.add_argument('path')
+      command.set_defaults(run=lambda options: import_archive(options.path))
+      command = commands.add_parser('serve', help="serve the archive over HTTP until interrupted")
+      command.add_argument('--host', default=SERVER_HOST, help=f"address to listen on, {SERVER_HOST} by default")
+      command.add_argument('--port', type=int, default=SERVER_PORT, help=f"port to listen on, {SERVER_PORT} by default")
+      command.set_defaults(run=lambda options: serve(options.host, options.port))
+      command = commands.add_parser('ping', help="check the API key with the NASA servers")
+      command.set_defaults(run=lambda options: ping())
+      options = parser.parse_args(arguments)
+      # Only the output of the command goes to the standard output, so it can be piped to other tools
+      output = sys.stdout
+      def run(options):
+            with contextlib.redirect_stdout(output):
+                  options.run(options)
+      with contextlib.redirect_stdout(sys.stderr):
+            # Connect to database
+            connect(DATABASE_FILE)
+            try:
+                  if (options.profile):
+                        profile_call(" ".join(arguments), run, options)
+                  else:
+                        run(options)
+                  # Leave the numbers for a collector
+                  if (options.metrics):
+                        stats(['prometheus', options.metrics])
+            finally:
+                  stop_viewer()
+                  close_database()
 #
 # Main
 #
-if __name__ == "__main__":
+if __name__ == "__main__" and len(sys.argv) > 1:
+      # Run the command given on the command line
+      command_line(sys.argv[1:])
+elif __name__ == "__main__":
       
       # Connect to database
-      database = connect("database")
-      # Create a cursor
-      cursor = database.cursor()
-      # Raise a system exit if can't connect to database
-      #if (database_connection and cursor is None):
-            # Warn user about errorous database connection.
-      #      print("[ERROR] Database not responsive. Exiting...")
-            # Raise the exit
-      #      raise SystemExit
-      #else:
-            # Turn on auto_update process
-            #update_process = multiprocessing.Process(target=auto_update)
-            # Start the process
-            #update_process.start()
-      #     pass
+      connect(DATABASE_FILE)
+      # Turn on the auto update thread
+      update_stop = threading.Event()
+      update_thread = threading.Thread(target=auto_update, args=(update_stop,), name="auto-update", daemon=True)
+      update_thread.start()
       # Print the main interface
       main_interface()
       # The program loop
@@ -443,88 +2613,35 @@ if __name__ == "__main__":
                   # Change line
                   print("\n")
                   # User input handling
-                  user_input = str(input()).lower()
+                  user_input = str(input())
+                  # Split the command from its options, which are kept as typed since some are paths
+                  command, *arguments = user_input.split() or [""]
+                  command = command.lower()
                   
                   # Functions
-                  if (user_input == "exit"):
+                  if (command == "exit"):
                         # Exit the program
                         break
-                  elif (user_input == "help"):
-                        # Print the help interface
-                        help_interface()
-                  elif (user_input == "update"):
-                        # Refresh database
-                        update()
-                  elif (user_input == "list"):
-                        # Show all entries
-                        list()
-                  elif (user_input == "search"):
-                        # Prompt a user input event
-                        search_request = str(input(": "))
-                        # Send request to search() function
-                        search(search_request)
-                  elif (user_input == "apod"):
-                        # Print the image of day
-                        apod()
-                  elif (user_input == "delete"):
-                        # Ask user which entry to remove by ID
-                        delete_request = str(input(": "))
-                        delete(delete_request)
-                  elif (user_input == "view"):
-                        # View a specific entry
-                        view_request = str(input(": "))
-                        view(view_request)
-                  elif (user_input == "ping"):
-                        # Ping the servers
-                        ping(NASA_API_KEY)
-                  elif (user_input == "api"):
-                        # Change or modify API key
-                        print("[INFO] Enter new API key.")
-                        # Ask user for new API key
-                        new_api = str(input(": "))
-                        print("[INFO] Changing API key...")
-                        # Try to verify the new API
-                        response = ping(new_api)
-                        # Check the response from the server
-                        if (response == 200):
-                              NASA_API_KEY = new_api
-                              print("[INFO] API key changed successfully.")
-                        else:
-                              print("[ERROR] Unable to change API key.")
-                  elif (user_input == "clear"):
-                        # Clear the terminal
-                        clear()
-                  elif (user_input == ""):
-                        # Just skip line
-                        pass
-                  else:
-                        # Warn user for providing invalid input
-                        print(f"[ERROR] Command '{user_input}'' not found.")
+                  # Run the command
+                  run_command(command, arguments)
             # Handle keyboard interrupts
             except KeyboardInterrupt:
                   print("[WARNING] To exit the program type 'EXIT' on the prompt")
-      #if (database and cursor is not None):
-            # Close database connection
-            #terminate_connection(database, cursor)
-      print("[INFO] Closing cursor...")
-      time.sleep(1)
-      cursor.close()
-      print("[INFO] Closed cursor.")
-      time.sleep(1)
+      # Stop the auto update thread and wait for its current step to finish
+      print("[INFO] Terminating auto-update process...")
+      update_stop.set()
+      request_stop.set()
+      update_thread.join(SHUTDOWN_TIMEOUT)
+      if (update_thread.is_alive()):
+            print("[WARNING] The auto-update process is still waiting for the NASA servers, leaving it behind.")
+      else:
+            print("[INFO] Terminating auto-update process... DONE")
+      # Close the image viewer
+      stop_viewer()
+      # Close database connection
       print("[INFO] Closing database...")
-      time.sleep(1)
-      database.close()
+      close_database()
       print("[INFO] Closed database.")
-      # Warn user that auto_update process is about to stop
-      print("[INFO] Terminating auto-update process...")
-      # Terminate auto_update process when parent process terminated
-      #update_process.terminate()
-      # Wait a sec
-      time.sleep(1)
-      # Inform user
-      print("[INFO] Terminating auto-update process... DONE")
-      # Wait for another sec
-      time.sleep(1)
 #
 # Program exit
 #
\ No newline at end of file
@@ -0,0 +1,117 @@
+#
+# Round-trip tests of the archive export and import, run with pytest against
+# a temporary collection and database.
+#
+#
+# Imports
+import hashlib
+import os
+import tarfile
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+import main
+
+
+#
+# Point the application at an empty collection under a folder
+#
+def use_collection(directory):
+      main.close_database()
+      os.makedirs(directory, exist_ok=True)
+      main.APOD_DIRECTORY = os.path.join(directory, 'APOD')
+      main.STORE_DIRECTORY = os.path.join(main.APOD_DIRECTORY, 'store')
+      main.THUMBNAIL_DIRECTORY = os.path.join(main.APOD_DIRECTORY, 'thumbnails')
+      main.HTTP_CACHE_FILE = os.path.join(main.APOD_DIRECTORY, 'http_cache.db')
+      main.connect(os.path.join(directory, 'database'))
+#
+# Read the entries as the archive carries them, by date
+#
+def archived_entries():
+      rows = main.fetch_all("SELECT date, title, explanation, url, added, media_type, image_url, image_location FROM entries ORDER BY date")
+      entries = {}
+      for *properties, image_location in rows:
+            # Compare the images by the SHA-256 of their bytes
+            checksum = None
+            if (image_location):
+                  with open(image_location, "rb") as image_file:
+                        checksum = hashlib.sha256(image_file.read()).hexdigest()
+            entries[properties[0]] = (tuple(properties), checksum)
+      return entries
+#
+# A collection with a few entries, one of them a video without its image
+#
+@pytest.fixture
+def collection(tmp_path, monkeypatch):
+      settings = {name: getattr(main, name) for name in ('APOD_DIRECTORY', 'STORE_DIRECTORY', 'THUMBNAIL_DIRECTORY', 'HTTP_CACHE_FILE')}
+      monkeypatch.setenv('HOME', str(tmp_path))
+      use_collection(str(tmp_path / 'source'))
+      rows = []
+      for day in range(1, 4):
+            date = f"2024-01-0{day}"
+            # Every entry gets a different image
+            buffer = BytesIO()
+            Image.new('RGB', (64, 48), (day * 60, 255 - day * 40, day * 20)).save(buffer, 'JPEG')
+            image_location = main.store_chunks(iter([buffer.getvalue()]), '.jpg')
+            rows.append(main.entry_row({'date': date, 'title': f"Nebula {date}", 'explanation': "A glowing nebula.", 'url': f"https://apod.example/{date}.jpg"},
+                                       image_location, main.image_hash(image_location), f"https://apod.example/{date}.jpg"))
+      rows.append(main.entry_row({'date': "2024-01-04", 'title': "A video", 'explanation': "Only a video.", 'url': "https://video.example/4",
+                                  'media_type': 'video'}, ""))
+      with main.transaction() as connection:
+            main.create_entries(connection, rows)
+      yield tmp_path
+      main.close_database()
+      for name, value in settings.items():
+            setattr(main, name, value)
+#
+# Exporting and importing into a fresh database keeps the entries and the bytes of their images
+#
+@pytest.mark.parametrize('archive_name', ["archive.tar", "archive.tar.gz"])
+def test_round_trip(collection, archive_name):
+      archive_path = str(collection / archive_name)
+      exported = archived_entries()
+      main.export_archive(archive_path)
+      use_collection(str(collection / 'destination'))
+      main.import_archive(archive_path)
+      imported = archived_entries()
+      assert imported == exported
+      # The images were copied into the new store
+      assert all(location.startswith(main.STORE_DIRECTORY) for location, in main.fetch_all("SELECT image_location FROM entries WHERE image_location IS NOT NULL"))
+#
+# Importing the same archive twice adds nothing the second time
+#
+def test_import_twice(collection):
+      archive_path = str(collection / "archive.tar")
+      main.export_archive(archive_path)
+      use_collection(str(collection / 'destination'))
+      main.import_archive(archive_path)
+      imported = archived_entries()
+      main.import_archive(archive_path)
+      assert archived_entries() == imported
+#
+# An image that does not match its checksum is left out, along with its bytes
+#
+def test_checksum_mismatch(collection):
+      archive_path = str(collection / "archive.tar")
+      main.export_archive(archive_path)
+      # Change the bytes of one image, keeping its name
+      tampered_path = str(collection / "tampered.tar")
+      with tarfile.open(archive_path) as archive, tarfile.open(tampered_path, "w") as tampered:
+            members = archive.getmembers()
+            image_name = next(member.name for member in members if member.name.startswith("images/"))
+            for member in members:
+                  data = archive.extractfile(member).read()
+                  if (member.name == image_name):
+                        data = data[:-1] + bytes([data[-1] ^ 0xFF])
+                        member.size = len(data)
+                  tampered.addfile(member, BytesIO(data))
+      use_collection(str(collection / 'destination'))
+      main.import_archive(tampered_path)
+      stored = [os.path.join(directory, filename) for directory, _, filenames in os.walk(main.STORE_DIRECTORY) for filename in filenames]
+      referenced = [location for location, in main.fetch_all("SELECT image_location FROM entries WHERE image_location IS NOT NULL")]
+      # Every entry is imported, the tampered one without its image, and no stray file is kept
+      assert main.fetch_one("SELECT COUNT(*) FROM entries")[0] == 4
+      assert len(referenced) == 2
+      assert sorted(stored) == sorted(referenced)